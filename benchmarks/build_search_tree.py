@@ -0,0 +1,76 @@
+"""
+Benchmark building the search tree
+
+Compares tokenizing every extended name with a separate spaCy call, as the tree used to be built, with deduplicated
+names tokenized in batches, sequentially and in parallel, and checks all builds give the same tree.
+
+    python benchmarks/build_search_tree.py --workers 4
+"""
+import argparse
+import json
+import os
+import time
+
+from txt2hpo import resources
+from txt2hpo.build_tree import build_search_tree
+from txt2hpo.nlp import stem_token
+
+
+def build_search_tree_per_name():
+    """search tree built with one spaCy call per extended name"""
+    ontology = resources.get('ontology')
+    nlp_sans_ner = resources.get('nlp_sans_ner')
+    terms = {}
+    for node, name, synonyms in zip(ontology.ids, ontology.names, ontology.synonyms):
+        if node == 'HP:0000001':
+            continue
+        names = [name] + synonyms
+        extended_names = []
+        for name in names:
+            name = name.replace(', ', ' ').replace(',', ' ')
+            extended_names += [name.lower(), name.capitalize(), name.title(), name.replace('-', ' '),
+                               name.replace('Abnormality', 'Disorder')]
+        for name in extended_names:
+            tokens = [stem_token(x) for x in nlp_sans_ner(name) if not x.is_stop and not x.is_punct]
+            for token in tokens:
+                keys = terms.setdefault(token, {}).setdefault(len(tokens), {})
+                hpids = keys.setdefault(' '.join(sorted(tokens)), [])
+                if node not in hpids:
+                    hpids.append(node)
+    return terms
+
+
+def timed(build):
+    stem_token.clear()
+    start = time.time()
+    tree = build()
+    return tree, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of processes of parallel build')
+    parser.add_argument('--batch-size', type=int, default=1000, help='number of names tokenized together')
+    args = parser.parse_args()
+
+    resources.preload('ontology', 'nlp_sans_ner', 'stemmer')
+
+    builds = [
+        ('one call per name', build_search_tree_per_name),
+        ('batched', lambda: build_search_tree(batch_size=args.batch_size)),
+        (f'batched, {args.workers} workers', lambda: build_search_tree(n_workers=args.workers,
+                                                                       batch_size=args.batch_size)),
+    ]
+
+    reference = None
+    print()
+    for name, build in builds:
+        tree, seconds = timed(build)
+        if reference is None:
+            reference = json.dumps(tree)
+        same = json.dumps(tree) == reference
+        print(f'{name:<30} {seconds:8.2f}s  {len(tree)} stems  {"same tree" if same else "DIFFERENT TREE"}')
+
+
+if __name__ == '__main__':
+    main()
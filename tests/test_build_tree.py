@@ -1,7 +1,11 @@
 import unittest
+import json
+import os
+import tempfile
 import time
 
-from txt2hpo.build_tree import build_search_tree
+from txt2hpo.build_tree import build_search_tree, build_overlay_tree, search_tree_header, OverlayTree
+from txt2hpo.compact_tree import CompactTree, write_compact_tree
 
 
 class BuildTreeTestCase(unittest.TestCase):
@@ -17,3 +21,51 @@ class BuildTreeTestCase(unittest.TestCase):
         search_tree = build_search_tree(custom_synonyms)
         self.assertEqual(search_tree['dd'], {1: {'dd': ['HP:0001263']}})
         self.assertEqual(search_tree['gdd'], {1: {'gdd': ['HP:0001263']}})
+
+        # masked terms are left out, without modifying the list passed
+        masked_terms = ['HP:0001263']
+        search_tree = build_search_tree(custom_synonyms, masked_terms=masked_terms)
+        self.assertNotIn('gdd', search_tree)
+        self.assertEqual(masked_terms, ['HP:0001263'])
+
+    def test_compact_tree(self):
+        custom_synonyms = {"HP:0001263": ['DD', 'GDD']}
+        search_tree = build_search_tree(custom_synonyms)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'parsing_tree.bin')
+            write_compact_tree(search_tree, path, header=search_tree_header())
+            compact_tree = CompactTree(path)
+
+            self.assertEqual(compact_tree.header['obo_version'], search_tree_header()['obo_version'])
+            self.assertEqual(list(search_tree), list(compact_tree))
+            self.assertIn('gdd', compact_tree)
+            self.assertNotIn('not_a_stem', compact_tree)
+            self.assertEqual(compact_tree['gdd'][1]['gdd'], ['HP:0001263'])
+            self.assertIn(1, compact_tree.get('dd', ()))
+            self.assertNotIn(2, compact_tree.get('dd', ()))
+            with self.assertRaises(KeyError):
+                compact_tree['dd'][1]['gdd']
+
+            for stem, lengths in search_tree.items():
+                self.assertEqual(lengths, {n: dict(keys.items()) for n, keys in compact_tree[stem].items()})
+            compact_tree.close()
+
+    def test_parallel_build(self):
+        # test batched and parallel builds give the same tree, in the same order
+        search_tree = build_search_tree()
+        self.assertEqual(json.dumps(search_tree), json.dumps(build_search_tree(batch_size=3)))
+        self.assertEqual(json.dumps(search_tree), json.dumps(build_search_tree(n_workers=2, batch_size=5)))
+
+    def test_overlay_tree(self):
+        # test overlay of custom synonyms on the tree of the ontology finds the same terms as a tree built with them
+        custom_synonyms = {"HP:0001263": ['DD', 'GDD', 'Abnormality of the head'], "HP:9999999": ['not in ontology']}
+        search_tree = build_search_tree()
+        overlay_tree = OverlayTree(search_tree, build_overlay_tree(custom_synonyms))
+        full_tree = build_search_tree(custom_synonyms)
+
+        self.assertEqual(set(overlay_tree), set(full_tree))
+        self.assertEqual(len(overlay_tree), len(full_tree))
+        for stem, lengths in full_tree.items():
+            self.assertEqual(lengths, overlay_tree[stem])
+        self.assertNotIn('gdd', search_tree)
+        self.assertEqual(json.dumps(search_tree), json.dumps(build_search_tree()))
@@ -0,0 +1,57 @@
+import unittest
+import os
+import tempfile
+import time
+
+from txt2hpo.config import config
+from txt2hpo.cache import artifact_key, artifact_path, collect_garbage, file_fingerprint, save_atomic
+
+
+class CacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.startTime = time.time()
+
+    def tearDown(self):
+        t = time.time() - self.startTime
+        print('%s: %.3f' % (self.id(), t))
+
+    def test_artifact_key(self):
+        self.assertEqual(artifact_key(dict(a=1, b=[1, 2])), artifact_key(dict(b=[1, 2], a=1)))
+        self.assertNotEqual(artifact_key(dict(a=1, b=[1, 2])), artifact_key(dict(a=1, b=[2, 1])))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'source.txt')
+            with open(path, 'wt') as fh:
+                fh.write('hypotonia')
+            fingerprint = file_fingerprint(path)
+            self.assertEqual(fingerprint, file_fingerprint(path))
+            with open(path, 'wt') as fh:
+                fh.write('hypertonia')
+            os.utime(path, ns=(0, 10 ** 9))
+            self.assertNotEqual(fingerprint, file_fingerprint(path))
+
+    def test_collect_garbage(self):
+        parsing_tree = config.get('tree', 'parsing_tree')
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config.set('tree', 'parsing_tree', os.path.join(tmp_dir, 'parsing_tree.pkl'))
+            try:
+                name = 'test_artifact'
+                current = artifact_path(name, 'current', 'npz')
+                variant = artifact_path(name, 'current', 'npz', variant='custom')
+                stale = [artifact_path(name, f'stale{i}', 'npz') for i in range(3)]
+                legacy = os.path.join(tmp_dir, f'{name}.npz')
+                other = artifact_path(f'{name}_other', 'stale', 'npz')
+                for i, path in enumerate([current, variant, legacy, other] + stale):
+                    save_atomic(path, lambda fh: fh.write(b'artifact'))
+                    os.utime(path, (i, i))
+
+                # the most recently modified artifacts of other sources are kept, e.g. of other installs
+                self.assertEqual(collect_garbage(name, 'current'), [stale[0]])
+                self.assertEqual(collect_garbage(name, 'current', keep=1), [stale[1]])
+
+                # files without a key are only removed when asked for
+                self.assertEqual(collect_garbage(name, 'current', legacy=True), [legacy])
+                for path in [current, variant, other, stale[2]]:
+                    self.assertTrue(os.path.isfile(path))
+            finally:
+                config.set('tree', 'parsing_tree', parsing_tree)
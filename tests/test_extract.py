@@ -1,10 +1,12 @@
 import unittest
+from unittest import mock
 import time
 import json
-from txt2hpo.extract import Extractor, Data, group_sequence
+from txt2hpo.extract import Extractor, Data, group_sequence, assemble_groups, recombine_groups
 from txt2hpo.data import load_model
 from tests.test_cases import *
 from txt2hpo.util import hpo_network, non_phenos
+from txt2hpo import resources
 
 
 class ExtractPhenotypesTestCase(unittest.TestCase):
@@ -19,6 +21,35 @@ class ExtractPhenotypesTestCase(unittest.TestCase):
         truth = [[0, 1], [3]]
         self.assertEqual(group_sequence([0, 1, 3]), truth)
 
+    def test_assemble_recombine_groups(self):
+        groups = assemble_groups([[1, 2], [5, 6]], max_distance=3)
+        self.assertEqual(groups, {((1, 2), (5, 6)), (1, 2), (5, 6)})
+        truth = [[1, 2], [1], [2], [5], [1, 2, 5], [1, 5], [2, 5]]
+        result = recombine_groups({((1, 2), (5,)), (1, 2), (5,)})
+        self.assertEqual(sorted(truth), sorted(result))
+        self.assertEqual(len(result), len(set(tuple(x) for x in result)))
+
+    def test_max_candidates(self):
+        truth = [{"hpid": ["HP:0000365"], "index": [0, 12], "matched": "Hearing loss"},
+                 {"hpid": ["HP:0001263"], "index": [23, 42], "matched": "developmental delay"}]
+
+        # phrases are probed from left to right
+        extract = Extractor(correct_spelling=False, max_candidates=1)
+        self.assertEqual(extract.hpo("Hearing loss following developmental delay").entries_sans_context, truth[:1])
+        self.assertEqual(extract.candidate_stats['capped_chunks'], 1)
+        self.assertEqual(extract.candidate_stats['capped_fused'], 1)
+
+        # only distinct phrases of a phrase length of their root count against the limit
+        extract = Extractor(correct_spelling=False, max_candidates=2)
+        self.assertEqual(extract.hpo("Hearing loss following developmental delay").entries_sans_context, truth)
+        self.assertEqual(extract.candidate_stats['capped_chunks'], 0)
+
+        extract = Extractor(correct_spelling=False)
+        self.assertEqual(extract.hpo("Hearing loss following developmental delay").entries_sans_context, truth)
+        self.assertEqual(extract.candidate_stats['capped_chunks'], 0)
+        self.assertEqual(extract.candidate_stats['capped_fused'], 0)
+        self.assertGreater(extract.candidate_stats['candidates'], 0)
+
     def test_hpo(self):
 
         extract = Extractor(correct_spelling=False)
@@ -192,6 +223,64 @@ class ExtractPhenotypesTestCase(unittest.TestCase):
         for sentence in sentences:
             self.assertNotEqual(extract.hpo(sentence).n_entries, 0)
 
+    def test_hpo_batch(self):
+        # test batch extraction matches extracting one text at a time
+        texts = ['Developmental delay', 'Hypotonia', '', 'Male with eczema, skin rash, and sparse hair',
+                 'developmental delay with no wide mouth', test_case11_text]
+        for extract in [Extractor(correct_spelling=False), Extractor(remove_negated=True)]:
+            truth = [extract.hpo(text).entries_sans_context for text in texts]
+            result = [data.entries_sans_context for data in extract.hpo_batch(texts, batch_size=2)]
+            self.assertEqual(truth, result)
+
+    def test_parse_once(self):
+        # test tokenizing whole documents gives the same offsets as tokenizing each phrase
+        texts = ['Hypotonia, developmental delay', 'Male with eczema, skin rash, and sparse hair',
+                 'e.g. 3.5 kidney disease\nhypotonia\r\nseizures; Myoclonus Seizures', test_case11_text,
+                 'Patient has hypotonia.seizures', 'seizures;hypotonia', 'Hypotonia, 1,000 mg b.i.d. i.e. seizures']
+        for kwargs in [dict(correct_spelling=False), dict(correct_spelling=False, remove_overlapping=False)]:
+            extract = Extractor(**kwargs)
+            extract_once = Extractor(parse_once=True, **kwargs)
+            for text in texts:
+                self.assertEqual(extract.hpo(text).entries_sans_context, extract_once.hpo(text).entries_sans_context)
+
+        # tokens crossing phrase boundaries are not dropped
+        self.assertEqual(['HP:0001250', 'HP:0001252'], sorted(extract_once.hpo('seizures;hypotonia').hpids))
+
+        # documents with decimals and abbreviations are tokenized once
+        text = 'e.g. 3.5 kidney disease, hypotonia.seizures and 1,000 mg b.i.d.'
+        nlp_sans_ner = resources.get('nlp_sans_ner')
+        with mock.patch.object(nlp_sans_ner, 'pipe', wraps=nlp_sans_ner.pipe) as pipe:
+            result = extract_once.hpo(text).entries_sans_context
+        self.assertEqual(pipe.call_count, 1)
+        self.assertEqual(pipe.call_args[0][0], [text])
+        self.assertEqual(result, extract.hpo(text).entries_sans_context)
+
+    def test_original_offsets(self):
+        # test spans of spell corrected terms point to the original text
+        text = 'Hyptonic child with devlopmental delay; wide mouth'
+        for parse_once in [False, True]:
+            extract = Extractor(correct_spelling=True, original_offsets=True, parse_once=parse_once)
+            result = extract.hpo(text).entries_sans_context
+            self.assertEqual(['HP:0001252', 'HP:0001263', 'HP:0000154'], [x['hpid'][0] for x in result])
+            for entry in result:
+                self.assertEqual(entry['matched'], text[entry['index'][0]:entry['index'][1]])
+            self.assertEqual([0, 8], result[0]['index'])
+
+    def test_automaton_engine(self):
+        # test single pass matcher finds the same terms as probing the search tree with groups of tokens
+        texts = ['Hearing loss following developmental delay', 'Male with eczema, skin rash, and sparse hair',
+                 'Polycystic kidney disease and myoclonus seizures.', 'developmental and delay',
+                 'Coloboma, microphthalmia, macrocephaly, ear pit.', test_case11_text]
+        for kwargs in [dict(correct_spelling=False, remove_overlapping=False),
+                       dict(correct_spelling=False, max_neighbors=1),
+                       dict(correct_spelling=False, max_neighbors=2)]:
+            extract = Extractor(**kwargs)
+            extract_automaton = Extractor(engine='automaton', **kwargs)
+            for text in texts:
+                truth = sorted(extract.hpo(text).entries_sans_context, key=lambda x: (x['index'], x['hpid']))
+                result = sorted(extract_automaton.hpo(text).entries_sans_context, key=lambda x: (x['index'], x['hpid']))
+                self.assertEqual(truth, result)
+
     def test_conflict_resolver(self):
 
         model = load_model()
@@ -273,6 +362,45 @@ class ExtractPhenotypesTestCase(unittest.TestCase):
         data.resolve_conflicts()
         self.assertEqual(truth, data.entries_sans_context)
 
+    def test_conflict_ranking(self):
+        # test keeping ranked terms with their scores
+        model = load_model()
+        context = "secundum, all underwent surgical repair for ASD except for 1 individual whose defect spontaneously closed"
+
+        def extracted():
+            return [{"hpid": ["HP:0000729", "HP:0001631"], "index": [44, 47], "matched": "ASD", "context": context},
+                    {"hpid": ["HP:0001631"], "index": [60, 66], "matched": "defect", "context": context}]
+
+        data = Data(entries=extracted(), model=model)
+        data.resolve_conflicts(top_k=None, keep_scores=True)
+        self.assertEqual(["HP:0001631", "HP:0000729"], data.entries[0]['hpid'])
+        self.assertEqual(2, len(data.entries[0]['scores']))
+        self.assertGreater(data.entries[0]['scores'][0], data.entries[0]['scores'][1])
+        self.assertEqual(["HP:0001631"], data.entries[1]['hpid'])
+        self.assertEqual(data.entries[0]['scores'][0], data.entries[1]['scores'][0])
+
+        data = Data(entries=extracted(), model=model)
+        data.resolve_conflicts(top_k=None, min_score=1.0)
+        self.assertEqual(["HP:0001631"], data.entries[0]['hpid'])
+        self.assertNotIn('scores', data.entries[0])
+
+        extract = Extractor(top_k=2, keep_scores=True)
+        result = extract.hpo("secundum, all underwent surgical repair for ASD except for 1 individual").entries_sans_context
+        self.assertEqual(["HP:0001631", "HP:0000729"], result[0]['hpid'])
+        self.assertEqual(2, len(result[0]['scores']))
+
+    def test_lazy_model(self):
+        # test doc2vec vectors are only loaded to resolve conflicts
+        extract = Extractor(resolve_conflicts=False)
+        result = extract.hpo("secundum, all underwent surgical repair for ASD")
+        self.assertIsNone(extract._model)
+        self.assertIsNone(result.model)
+
+        model = load_model()
+        self.assertIs(model, load_model())
+        extract = Extractor(model=model)
+        self.assertIs(model, extract.hpo("hypotonia").model)
+
     def test_custom_synonyms(self):
         # test adding custom synonyms
         custom_syn = {"HP:0001263": ['DD', 'GDD'], "HP:0000729": ['ASD', 'PDD']}
@@ -282,6 +410,45 @@ class ExtractPhenotypesTestCase(unittest.TestCase):
                             {"hpid": ["HP:0001263"], "index": [4, 6], "matched": "DD"}]
         self.assertEqual(extract.hpo("GDD DD").entries_sans_context, truth)
 
+        # test custom synonyms do not leak into the ontology or other extractors
+        self.assertNotIn('DD', hpo_network.nodes['HP:0001263'].get('synonyms', []))
+        self.assertNotIn('gdd', resources.get('search_tree'))
+        self.assertEqual(Extractor().hpo("GDD DD").entries_sans_context, [])
+
+    def test_masked_terms(self):
+        # test terms and subtrees are masked per call and for every call
+        text = "Hypotonia, seizures and developmental delay"
+        for engine in ['tree', 'automaton']:
+            extract = Extractor(correct_spelling=False, engine=engine)
+            self.assertEqual(set(extract.hpo(text).hpids), {'HP:0001252', 'HP:0001250', 'HP:0001263'})
+            self.assertEqual(set(extract.hpo(text, masked_terms=['HP:0001252']).hpids), {'HP:0001250', 'HP:0001263'})
+            self.assertEqual(extract.hpo(text, masked_subtrees=['HP:0000707']).hpids, [])
+            self.assertEqual(len(extract.hpo(text).hpids), 3)
+
+            extract = Extractor(correct_spelling=False, engine=engine, masked_terms=['HP:0001250'])
+            self.assertEqual(set(extract.hpo(text).hpids), {'HP:0001252', 'HP:0001263'})
+            self.assertEqual(extract.hpo(text, masked_terms=['HP:0001252', 'HP:9999999']).hpids, ['HP:0001263'])
+
+    def test_propagate(self):
+        # test extracted terms are counted along with their ancestors
+        ontology = resources.get('ontology')
+        data = Data(entries=[{'hpid': ['HP:0001263']}, {'hpid': ['HP:0001252']}, {'hpid': ['HP:0001263']}])
+
+        ids, counts = data.propagate()
+        counts = dict(zip([ontology.ids[x] for x in ids], counts.tolist()))
+        self.assertEqual(counts['HP:0001263'], 1)
+        self.assertEqual(counts['HP:0000707'], 2)
+        self.assertEqual(counts['HP:0000001'], 2)
+        self.assertEqual(set(counts), ontology.ancestors('HP:0001263') | ontology.ancestors('HP:0001252') |
+                         {'HP:0001263', 'HP:0001252'})
+
+        ids, counts = data.propagate(unique=False, roots=['HP:0000707', 'HP:0000478'])
+        self.assertEqual([ontology.ids[x] for x in ids], ['HP:0000707'])
+        self.assertEqual(counts.tolist(), [3])
+
+        ids, counts = data.propagate(levels=0)
+        self.assertEqual(sorted(ontology.ids[x] for x in ids), ['HP:0001252', 'HP:0001263'])
+
     def test_extract_ambiguous(self):
         # test resolver works
         extract = Extractor(resolve_conflicts=True)
@@ -1,7 +1,9 @@
 import unittest
+import gc
 import time
 
-from txt2hpo.nlp import similarity_term_to_context
+from txt2hpo.nlp import similarity_term_to_context, nlp_sans_ner, st, StemCache, NegationCache, nlp_model
+from txt2hpo.nlp import load_term_vectors
 from txt2hpo.data import load_model
 
 
@@ -33,4 +35,55 @@ class NLPCase(unittest.TestCase):
         t_chd_c_chd = similarity_term_to_context(term2, context2, model)
 
         self.assertGreater(t_aut_c_aut, t_chd_c_aut)
-        self.assertGreater(t_chd_c_chd, t_aut_c_chd)
\ No newline at end of file
+        self.assertGreater(t_chd_c_chd, t_aut_c_chd)
+
+    def test_stem_cache(self):
+        cache = StemCache(maxsize=2)
+        tokens = nlp_sans_ner("hypotonic hypotonic delayed speech")
+        stems = [cache(x) for x in tokens]
+        self.assertEqual(stems, [st.stem(st.stem(x.lemma_.lower())) for x in tokens])
+
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 3)
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['size'], 2)
+        self.assertEqual(stats['hit_rate'], 0.25)
+
+    def test_negation_cache(self):
+        negation_model = nlp_model()
+        cache = NegationCache(maxsize=1)
+        contexts = ['no developmental delay', 'has a wide mouth', 'no developmental delay']
+        negations = cache(negation_model, contexts)
+
+        for context, (negated_tokens, negated) in zip(contexts, negations):
+            truth = ' '.join([e.text for e in negation_model(context).ents if e._.negex])
+            self.assertEqual(truth, negated_tokens)
+            self.assertEqual([t.text for t in nlp_sans_ner(truth)], negated)
+        self.assertIn('delay', negations[0][1])
+        self.assertEqual([], negations[1][1])
+
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['size'], 1)
+
+        # test cached negations do not keep their model alive
+        del negation_model
+        gc.collect()
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_term_vectors(self):
+        model = load_model()
+        term_vectors = load_term_vectors(model)
+        self.assertIs(term_vectors, load_term_vectors(model))
+
+        contexts = ['In the sample, 14,516 children were diagnosed with , of whom 5,689 had neurological symptoms',
+                    'secundum, all underwent surgical repair except for 1 individual whose defect spontaneously closed',
+                    '']
+        terms = ['HP:0000729', 'HP:0001631']
+        scores = term_vectors.similarity([(terms, context) for context in contexts], model)
+        for context, context_scores in zip(contexts, scores):
+            for term, score in zip(terms, context_scores):
+                self.assertAlmostEqual(similarity_term_to_context(term, context, model), score, places=5)
@@ -0,0 +1,70 @@
+import unittest
+import os
+import tempfile
+import time
+
+import networkx as nx
+
+from txt2hpo import resources
+from txt2hpo.ontology import parse_ontology, read_ontology, save_ontology
+from txt2hpo.util import load_hpo_network
+
+
+class OntologyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.startTime = time.time()
+
+    def tearDown(self):
+        t = time.time() - self.startTime
+        print('%s: %.3f' % (self.id(), t))
+
+    def test_ontology(self):
+        # test snapshot holds the terms, synonyms and hierarchy of the networkx graph
+        hpo_network = load_hpo_network()
+        ontology = resources.get('ontology')
+        self.assertEqual(ontology.ids, list(hpo_network.nodes))
+        for hpid in ['HP:0001263', 'HP:0000478', 'HP:0000005']:
+            self.assertEqual(ontology.name(hpid), hpo_network.nodes[hpid]['name'])
+            self.assertEqual(ontology.synonyms[ontology.index[hpid]], hpo_network.nodes[hpid].get('synonyms', []))
+            self.assertEqual(set(ontology.parents(hpid)), set(hpo_network.successors(hpid)))
+            self.assertEqual(set(ontology.children(hpid)), set(hpo_network.predecessors(hpid)))
+            self.assertEqual(ontology.descendants(hpid), nx.ancestors(hpo_network, hpid))
+            self.assertEqual(ontology.ancestors(hpid), nx.descendants(hpo_network, hpid))
+        self.assertEqual(ontology.non_phenos['HP:0000005'], 'mode_of_inheritance')
+        self.assertNotIn('HP:0001263', ontology.non_phenos)
+
+    def test_snapshot(self):
+        # test saved snapshot reads back the parsed ontology
+        ontology = parse_ontology()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'ontology.npz')
+            save_ontology(ontology, path)
+            snapshot = read_ontology(path)
+
+        self.assertEqual(snapshot.ids, ontology.ids)
+        self.assertEqual(snapshot.names, ontology.names)
+        self.assertEqual(snapshot.synonyms, ontology.synonyms)
+        self.assertEqual(snapshot.non_phenos, ontology.non_phenos)
+        self.assertEqual(snapshot.version, ontology.version)
+        self.assertEqual(snapshot.parent_ids.tolist(), ontology.parent_ids.tolist())
+        self.assertEqual(snapshot.child_offsets.tolist(), ontology.child_offsets.tolist())
+        self.assertEqual(snapshot.ancestor_distances.tolist(), ontology.ancestor_distances.tolist())
+
+    def test_ancestor_closure(self):
+        # test hierarchy queries answered from the ancestor closure
+        hpo_network = load_hpo_network()
+        ontology = resources.get('ontology')
+        self.assertTrue(ontology.is_a('HP:0001263', 'HP:0000707'))
+        self.assertTrue(ontology.is_a('HP:0001263', 'HP:0001263'))
+        self.assertFalse(ontology.is_a('HP:0000707', 'HP:0001263'))
+        self.assertFalse(ontology.is_a('HP:0001263', 'HP:0000478'))
+
+        roots = [ontology.index['HP:0000707'], ontology.index['HP:0000478']]
+        labels = ontology.branch_labels(roots)
+        for hpid in ontology:
+            in_subtree = [hpid == x or x in nx.descendants(hpo_network, hpid) for x in ['HP:0000707', 'HP:0000478']]
+            expected = 1 if in_subtree[1] else 0 if in_subtree[0] else -1
+            self.assertEqual(labels[ontology.index[hpid]], expected)
+
+        self.assertEqual(ontology.term_types(['HP:0000005', 'HP:0001263', 'HP:9999999']),
+                         ['mode_of_inheritance', 'phenotype', 'phenotype'])
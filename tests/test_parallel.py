@@ -0,0 +1,29 @@
+import unittest
+import time
+
+from txt2hpo.extract import Extractor
+from txt2hpo.parallel import extract_corpus
+from tests.test_cases import test_case11_text
+
+
+class ParallelTestCase(unittest.TestCase):
+    def setUp(self):
+        self.startTime = time.time()
+
+    def tearDown(self):
+        t = time.time() - self.startTime
+        print('%s: %.3f' % (self.id(), t))
+
+    def test_extract_corpus(self):
+        texts = ['Developmental delay', 'Hypotonia', 'patient has developmental delay but no hypotonia',
+                 test_case11_text] * 3
+        extract = Extractor(correct_spelling=False, remove_negated=True)
+        truth = [extract.hpo(text) for text in texts]
+
+        result, stats = extract_corpus(texts, n_workers=2, shard_size=2, return_stats=True,
+                                       correct_spelling=False, remove_negated=True)
+
+        self.assertEqual([x.json for x in truth], [x.json for x in result])
+        self.assertEqual([x.negated_hpids for x in truth], [x.negated_hpids for x in result])
+        self.assertEqual(sum(x['n_texts'] for x in stats.values()), len(texts))
+        self.assertEqual(sum(x['candidate_stats']['chunks'] for x in stats.values()), extract.candidate_stats['chunks'])
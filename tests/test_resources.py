@@ -0,0 +1,45 @@
+import unittest
+import time
+
+from txt2hpo import resources
+
+
+class ResourcesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.startTime = time.time()
+
+    def tearDown(self):
+        t = time.time() - self.startTime
+        print('%s: %.3f' % (self.id(), t))
+
+    def test_lazy_resource(self):
+        calls = []
+
+        def load_numbers():
+            calls.append(1)
+            return [1, 2, 3]
+
+        # not preloaded, so later calls of preload() do not load it
+        resources.register('test_numbers', load_numbers, preload=False)
+        self.assertFalse(resources.is_loaded('test_numbers'))
+        self.assertEqual(resources.get('test_numbers'), [1, 2, 3])
+        self.assertIs(resources.get('test_numbers'), resources.get('test_numbers'))
+        self.assertEqual(len(calls), 1)
+        self.assertIn('test_numbers', resources.timings())
+
+        resources.clear('test_numbers')
+        self.assertFalse(resources.is_loaded('test_numbers'))
+        resources.get('test_numbers')
+        self.assertEqual(len(calls), 2)
+        resources.clear('test_numbers')
+
+    def test_preload(self):
+        import txt2hpo
+        timings = txt2hpo.preload('search_tree', 'non_phenos')
+        self.assertTrue(resources.is_loaded('search_tree'))
+        self.assertTrue(resources.is_loaded('ontology'))
+        for name in ['search_tree', 'non_phenos', 'ontology']:
+            self.assertGreaterEqual(timings[name], 0)
+
+        from txt2hpo.util import hpo_network
+        self.assertIs(hpo_network, resources.get('hpo_network'))
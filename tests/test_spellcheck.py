@@ -0,0 +1,40 @@
+import unittest
+import time
+
+from txt2hpo.spellcheck import correction, known, edits2, known_edits2, spellcheck, CorrectionCache
+
+
+class SpellcheckTestCase(unittest.TestCase):
+    def setUp(self):
+        self.startTime = time.time()
+
+    def tearDown(self):
+        t = time.time() - self.startTime
+        print('%s: %.3f' % (self.id(), t))
+
+    def test_known_edits2(self):
+        # deletion index finds the same words as generating all edits
+        for word in ['hypotnoai', 'devlpmental', 'seizurse', 'brachydatcyl', 'qqqqqqqq']:
+            self.assertEqual(known(edits2(word)), known_edits2(word))
+
+    def test_correction(self):
+        self.assertEqual(correction('hypotonia'), 'hypotonia')
+        self.assertEqual(correction('hyptonia'), 'hypotonia')
+        self.assertEqual(correction('hypotnoai'), 'hypotonia')
+        self.assertEqual(spellcheck('Hyptonic child'), 'Hypotonic child')
+
+    def test_correction_cache(self):
+        cache = CorrectionCache(maxsize=1)
+        self.assertEqual(cache('hypotonia'), 'hypotonia')
+        self.assertEqual(cache('hyptonia'), 'hypotonia')
+        self.assertEqual(cache('hyptonia'), 'hypotonia')
+        self.assertEqual(cache('devlopment'), correction('devlopment'))
+        self.assertEqual(cache('hyptonia', skip={'hyptonia'}), 'hyptonia')
+
+        stats = cache.stats()
+        self.assertEqual(stats['known'], 1)
+        self.assertEqual(stats['skipped'], 1)
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['size'], 1)
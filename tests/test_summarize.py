@@ -1,7 +1,13 @@
 import unittest
+import json
+import os
+import tempfile
+import warnings
 
 import tests.test_cases as tc
-from txt2hpo.summarize import phenotype_distance, distances
+from txt2hpo import resources
+from txt2hpo.extract import Data
+from txt2hpo.summarize import phenotype_distance, distances, propagate_corpus, PairAccumulator
 
 
 class ExtractPhenotypesTestCase(unittest.TestCase):
@@ -41,6 +47,17 @@ class ExtractPhenotypesTestCase(unittest.TestCase):
         result = [x for x in result if x[0] != x[1]]
         self.assertEqual(result, truth)
 
+    def test_phenotype_distance_array(self):
+        # test structured array and Data input give the same pairs as the list of tuples from json
+        truth = phenotype_distance(tc.test_case2)
+        result = phenotype_distance(tc.test_case2, as_array=True)
+        self.assertEqual(result.dtype.names, ('hpo1', 'hpo2', 'distance'))
+        self.assertEqual([tuple(x) for x in result.tolist()], truth)
+
+        data = Data(entries=list(reversed(json.loads(tc.test_case2))))
+        self.assertEqual(phenotype_distance(data), truth)
+        self.assertEqual(phenotype_distance('[]'), [])
+
     def test_distances(self):
         test_cases = [tc.test_case0, tc.test_case1, tc.test_case2]
         truth = [{'idx1': 'HP:0001290', 'idx2': 'HP:0001290', 'mean_score': 0.0, 'n': 3 },
@@ -57,4 +74,47 @@ class ExtractPhenotypesTestCase(unittest.TestCase):
                  {'idx1': 'HP:0000218', 'idx2': 'HP:0000218', 'mean_score': 0.0, 'n': 3}]
 
         result = distances(test_cases, min_n_distances=2).to_dict("records")
-        self.assertEqual(result, truth)
\ No newline at end of file
+        self.assertEqual(result, truth)
+
+    def test_pair_accumulator(self):
+        # test documents streamed one at a time, as json or Data, give the same summary
+        test_cases = [tc.test_case0, tc.test_case1, tc.test_case2]
+        accumulator = PairAccumulator()
+        accumulator.update(Data(entries=json.loads(x)) for x in test_cases)
+        self.assertEqual(len(accumulator.pairs), 6)
+        self.assertEqual(accumulator.summary(min_n_distances=1).to_dict("records"),
+                         distances(test_cases, min_n_distances=1).to_dict("records"))
+
+        result = distances(iter(test_cases), min_n_distances=1, summary_method='min').to_dict("records")
+        self.assertEqual(result[1], {'idx1': 'HP:0000218', 'idx2': 'HP:0001290', 'min_score': 0.6560929648241206, 'n': 3})
+
+        # terms all at offset 0 have no distance, without warnings
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            accumulator.add('[{"hpid": ["HP:0001290"], "index": [0, 9]}, {"hpid": ["HP:0000218"], "index": [0, 11]}]')
+
+    def test_distances_parallel(self):
+        # test results do not depend on the number of workers, and checkpoints of chunks are reused
+        test_cases = [tc.test_case0, tc.test_case1, tc.test_case2] * 3
+        truth = distances(test_cases, min_n_distances=1).to_dict("records")
+        result = distances(test_cases, min_n_distances=1, chunk_size=2, n_workers=2).to_dict("records")
+        self.assertEqual([(x['idx1'], x['idx2'], x['n']) for x in truth],
+                         [(x['idx1'], x['idx2'], x['n']) for x in result])
+        for x, y in zip(truth, result):
+            self.assertAlmostEqual(x['mean_score'], y['mean_score'])
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            checkpointed = distances(iter(test_cases), min_n_distances=1, chunk_size=2, checkpoint_dir=tmp_dir)
+            self.assertEqual(len(os.listdir(tmp_dir)), 5)
+            self.assertEqual(checkpointed.to_dict("records"), result)
+            resumed = distances(test_cases, min_n_distances=1, chunk_size=2, n_workers=2, checkpoint_dir=tmp_dir)
+            self.assertEqual(len(os.listdir(tmp_dir)), 5)
+            self.assertEqual(resumed.to_dict("records"), result)
+
+    def test_propagate_corpus(self):
+        ontology = resources.get('ontology')
+        results = [Data(entries=[{'hpid': ['HP:0001263']}]), Data(), Data(entries=[{'hpid': ['HP:0001252']}])]
+        indptr, indices, counts = propagate_corpus(results, roots=['HP:0000707', 'HP:0001252'])
+        self.assertEqual(indptr.tolist(), [0, 1, 1, 3])
+        self.assertEqual([ontology.ids[x] for x in indices], ['HP:0000707', 'HP:0000707', 'HP:0001252'])
+        self.assertEqual(counts.tolist(), [1, 1, 1])
@@ -1,2 +1,12 @@
 __project__ = 'txt2hpo'
 __version__ = '2021.0'
+
+
+def preload(*names):
+    """
+    Load resources of txt2hpo (ontology, language model, spellcheck dictionary, search tree) ahead of first use
+    :param names: names of resources to load, all resources if none
+    :return: dictionary of seconds spent loading each resource
+    """
+    from txt2hpo.resources import preload
+    return preload(*names)
@@ -1,69 +1,112 @@
-import configparser
+import multiprocessing
+import os
 import pickle
 import sys
+from collections.abc import Mapping
+import spacy
+from txt2hpo import __version__
+from txt2hpo.cache import artifact_key, artifact_path, collect_garbage, file_fingerprint, save_atomic
 from txt2hpo.config import logger, config
-from txt2hpo.util import hpo_network
-from txt2hpo.nlp import nlp_sans_ner
-from txt2hpo.nlp import st
+from txt2hpo.compact_tree import CompactTree, write_compact_tree
+from txt2hpo.util import obo_data_version
+from txt2hpo.nlp import stem_token, remove_from_stops, stem_pattern, stem_min_length
+from txt2hpo import resources
 
 
-def build_search_tree(custom_synonyms=None, masked_terms=None):
+def build_search_tree(custom_synonyms=None, masked_terms=None, n_workers=1, batch_size=1000):
     """
     Build stemmed, search tree for phenotypes / n-grams
+    Extended names of all terms are deduplicated and tokenized in batches, optionally in parallel, then added to the
+    tree in ontology order, so the tree is the same however it is built.
     :param hpo: hpo object from phenopy
     :param custom_synonyms: dictionary of hpo-id (key), list of synonyms (value)
     :param masked_terms: block specific hpids from parsing
+    :param n_workers: number of processes tokenizing names
+    :param batch_size: number of names tokenized together
     :return: nested dictionary
     """
     if custom_synonyms == None:
         custom_synonyms = {}
 
-    if masked_terms == None:
-        masked_terms = ['HP:0000001']
-    else:
-        masked_terms += ['HP:0000001']
+    masked_terms = set(masked_terms or []) | {'HP:0000001'}
+
+    ontology = resources.get('ontology')
 
     terms = {}
     logger.info('Building a stemmed parse tree, this may take a few seconds, dont worry this is a one time thing \n')
 
-    for hpid, synonyms in custom_synonyms.items():
-        if hpid in masked_terms:
-            continue
-        if hpid in hpo_network.nodes():
-            if 'synonyms' in hpo_network.nodes[hpid]:
-                hpo_network.nodes[hpid]['synonyms'] += synonyms
-            else:
-                hpo_network.nodes[hpid]['synonyms'] = synonyms
-
-    i = 0
-    n_nodes = len(hpo_network.nodes)
-
-    for node in hpo_network:
+    node_names = []
+    for node, term, synonyms in zip(ontology.ids, ontology.names, ontology.synonyms):
         if node in masked_terms:
             continue
-        term = hpo_network.nodes[node]['name']
-        if 'synonyms' in hpo_network.nodes[node]:
-            synonyms = hpo_network.nodes[node]['synonyms']
-        else:
-            synonyms = []
+
+        # custom synonyms extend the names of this tree only, the ontology is left as it is
+        if node in custom_synonyms:
+            synonyms = synonyms + list(custom_synonyms[node])
 
         names = [term] + synonyms
+        node_names.append((node, extend_names(names)))
+
+    add_names(terms, node_names, n_workers=n_workers, batch_size=batch_size)
+    logger.info('Done \n')
+
+    return terms
+
+
+def build_overlay_tree(custom_synonyms, masked_terms=None):
+    """
+    Build search tree of custom synonyms only, to be looked up together with the search tree of the ontology
+    :param custom_synonyms: dictionary of hpo-id (key), list of synonyms (value)
+    :param masked_terms: block specific hpids from parsing
+    :return: nested dictionary
+    """
+    masked_terms = set(masked_terms or []) | {'HP:0000001'}
+    ontology = resources.get('ontology')
+    node_order = resources.get('hpo_node_order')
+
+    # synonyms of terms missing from the ontology are ignored, as when building the whole tree
+    nodes = sorted((x for x in custom_synonyms if x in ontology and x not in masked_terms),
+                   key=node_order.get)
+    terms = {}
+    add_names(terms, [(node, extend_names(custom_synonyms[node])) for node in nodes])
+    return terms
+
+
+def extend_names(names):
+    """
+    Extend names using custom rules
+    :param names: list of names of a term
+    :return: list of variants of names
+    """
+    extended_names = []
+    for name in names:
+        name = name.replace(', ',' ')
+        name = name.replace(',', ' ')
+        extended_names.append(name.lower())
+        extended_names.append(name.capitalize())
+        extended_names.append(name.title())
+        extended_names.append(name.replace('-',' '))
+        extended_names.append(name.replace('Abnormality', 'Disorder'))
+    return extended_names
 
-        # extend names using custom rules
-        extended_names = []
-        for name in names:
-            name = name.replace(', ',' ')
-            name = name.replace(',', ' ')
-            extended_names.append(name.lower())
-            extended_names.append(name.capitalize())
-            extended_names.append(name.title())
-            extended_names.append(name.replace('-',' '))
-            extended_names.append(name.replace('Abnormality', 'Disorder'))
 
+def add_names(terms, node_names, n_workers=1, batch_size=1000):
+    """
+    Add stemmed names of terms to a search tree
+    :param terms: nested dictionary to extend
+    :param node_names: list of tuples (hpo id, list of names), added in order
+    :param n_workers: number of processes tokenizing names
+    :param batch_size: number of names tokenized together
+    :return: None
+    """
+    # many extended names are identical, tokenize each once
+    unique_names = list(dict.fromkeys(name for _, names in node_names for name in names))
+    stemmed_names = dict(zip(unique_names, stem_names(unique_names, n_workers=n_workers, batch_size=batch_size)))
+
+    for node, extended_names in node_names:
         for name in extended_names:
 
-            tokens = nlp_sans_ner(name)
-            tokens = [st.stem(st.stem(x.lemma_.lower())) for x in tokens if not x.is_stop and not x.is_punct]
+            tokens = stemmed_names[name]
             for token in tokens:
                 if token not in terms:
                     terms[token] = {}
@@ -76,12 +119,136 @@ def build_search_tree(custom_synonyms=None, masked_terms=None):
                 elif node not in terms[token][len(tokens)][name_identifier]:
                     terms[token][len(tokens)][name_identifier].append(node)
 
-        i += 1
-        progress = i/n_nodes
-        update_progress(progress)
-    logger.info('Done \n')
 
-    return terms
+class OverlayTree(object):
+    """
+    Search tree of the ontology overlaid with a search tree of custom synonyms
+    Phrases of the overlay are merged with the same phrases of the base tree once, when the overlay is created, HPO IDs
+    of phrases in both trees in ontology order, so lookups give the same HPO IDs as a tree built with the custom
+    synonyms. Other phrases, phrase lengths and roots are looked up in the base tree, which is shared and never
+    modified, so an overlay costs time and memory in proportion to the number of custom synonyms.
+    """
+
+    def __init__(self, base, overlay):
+        self.base = base
+        self.overlay = overlay
+        node_order = resources.get('hpo_node_order')
+
+        self.merged = {}
+        for stem, lengths in overlay.items():
+            base_lengths = base.get(stem, {})
+            merged = {}
+            for n, keys in lengths.items():
+                base_keys = base_lengths.get(n, {})
+                merged_keys = {}
+                for key, hpids in keys.items():
+                    base_hpids = base_keys.get(key)
+                    if base_hpids:
+                        merged_keys[key] = sorted(set(base_hpids) | set(hpids), key=node_order.get)
+                    else:
+                        merged_keys[key] = list(hpids)
+                merged[n] = _Overlaid(base_keys, merged_keys)
+            self.merged[stem] = _Overlaid(base_lengths, merged)
+
+    def __contains__(self, stem):
+        return stem in self.merged or stem in self.base
+
+    def __getitem__(self, stem):
+        try:
+            return self.merged[stem]
+        except KeyError:
+            return self.base[stem]
+
+    def get(self, stem, default=None):
+        try:
+            return self.merged[stem]
+        except KeyError:
+            return self.base.get(stem, default)
+
+    def __len__(self):
+        return len(self.base) + sum(1 for stem in self.merged if stem not in self.base)
+
+    def __iter__(self):
+        for stem in self.base:
+            yield stem
+        for stem in self.merged:
+            if stem not in self.base:
+                yield stem
+
+    def keys(self):
+        return iter(self)
+
+    def values(self):
+        for stem in self:
+            yield self[stem]
+
+    def items(self):
+        for stem in self:
+            yield stem, self[stem]
+
+
+class _Overlaid(Mapping):
+    """Root or phrases of a length of the base tree, overlaid with merged entries which are looked up first"""
+
+    def __init__(self, base, merged):
+        self.base = base
+        self.merged = merged
+
+    def __contains__(self, key):
+        return key in self.merged or key in self.base
+
+    def __getitem__(self, key):
+        try:
+            return self.merged[key]
+        except KeyError:
+            return self.base[key]
+
+    def get(self, key, default=None):
+        try:
+            return self.merged[key]
+        except KeyError:
+            return self.base.get(key, default)
+
+    def __len__(self):
+        return len(self.base) + sum(1 for key in self.merged if key not in self.base)
+
+    def __iter__(self):
+        for key in self.base:
+            yield key
+        for key in self.merged:
+            if key not in self.base:
+                yield key
+
+
+def stem_names(names, n_workers=1, batch_size=1000):
+    """
+    Tokenize names with nlp.pipe and stem their tokens, leaving out stop words and punctuation
+    :param names: list of strings
+    :param n_workers: number of processes, batches are shared out to forked workers if more than 1
+    :param batch_size: number of names tokenized together
+    :return: list of lists of stems, in the order of names
+    """
+    batches = [names[i:i + batch_size] for i in range(0, len(names), batch_size)]
+    stemmed = []
+    if n_workers > 1 and len(batches) > 1:
+        # load language model before forking, workers share it
+        resources.get('nlp_sans_ner')
+        with multiprocessing.get_context('fork').Pool(n_workers) as pool:
+            for i, batch_stems in enumerate(pool.imap(_stem_batch, batches)):
+                stemmed += batch_stems
+                update_progress((i + 1) / len(batches))
+    else:
+        for i, batch in enumerate(batches):
+            stemmed += _stem_batch(batch)
+            update_progress((i + 1) / len(batches))
+    return stemmed
+
+
+def _stem_batch(names):
+    """stems of each name in a batch"""
+    nlp_sans_ner = resources.get('nlp_sans_ner')
+    return [[stem_token(x) for x in tokens if not x.is_stop and not x.is_punct]
+            for tokens in nlp_sans_ner.pipe(names, batch_size=len(names))]
 
 
 def update_progress(progress):
@@ -104,13 +271,75 @@ def update_progress(progress):
     sys.stdout.write(text)
     sys.stdout.flush()
 
-try:
-    with open(config.get('tree', 'parsing_tree'), 'rb') as fh:
-        search_tree = pickle.load(fh)
 
-except (FileNotFoundError, TypeError, configparser.NoSectionError) as e:
-    logger.info(f'Parsed search tree not found\n {e}')
-    search_tree = build_search_tree()
-    with open(config.get('tree', 'parsing_tree'), 'wb') as fh:
-        pickle.dump(search_tree, fh)
+def load_search_tree():
+    """
+    Load search tree from disk, build and save it if missing
+    Trees are saved under a key of the sources they are built from, see search_tree_sources, so trees built from
+    other sources are never loaded and are removed when a tree is rebuilt. The format is chosen by the 'format' option
+    of the [tree] config section, 'pickle' (default) or 'compact'.
+    :return: nested dictionary, or CompactTree
+    """
+    compact = config.get('tree', 'format', fallback='pickle') == 'compact'
+    key = artifact_key(search_tree_sources())
+    path = artifact_path(search_tree_name(), key, 'bin' if compact else 'pkl')
+
+    try:
+        if compact:
+            return CompactTree(path)
+        with open(path, 'rb') as fh:
+            return pickle.load(fh)
+    except (FileNotFoundError, OSError, ValueError, EOFError, pickle.UnpicklingError) as e:
+        logger.info(f'Parsed search tree not found\n {e}')
+
+    search_tree = build_search_tree(n_workers=config.getint('tree', 'build_workers', fallback=1))
+    if compact:
+        write_compact_tree(search_tree, path, header=search_tree_header())
+        search_tree = CompactTree(path)
+    else:
+        save_atomic(path, lambda fh: pickle.dump(search_tree, fh))
+    collect_garbage(search_tree_name(), key, legacy=True)
+
+    return search_tree
+
+
+resources.register('search_tree', load_search_tree)
+
+
+def __getattr__(name):
+    # resources are loaded on first access of their module attribute
+    if name in ('search_tree', 'hpo_network'):
+        return resources.get(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
+
+def search_tree_name():
+    """name of search tree files, from the configured parsing tree path"""
+    return os.path.splitext(os.path.basename(config.get('tree', 'parsing_tree')))[0]
+
+
+def search_tree_header():
+    """
+    Describe what a search tree is built from
+    :return: dictionary of versions of hp.obo, txt2hpo and the spaCy model tokenizing names
+    """
+    meta = resources.get('nlp_sans_ner').meta
+    return dict(obo_version=obo_data_version(),
+                txt2hpo_version=__version__,
+                spacy_version=spacy.__version__,
+                spacy_model=f"{meta.get('lang')}_{meta.get('name')}-{meta.get('version')}",
+                )
+
+
+def search_tree_sources():
+    """
+    Describe everything a search tree depends on, its key changes whenever one of them does
+    :return: dictionary of fingerprint of hp.obo, stop words, stemmer and versions of txt2hpo and language libraries
+    """
+    import nltk
+    return dict(search_tree_header(),
+                obo=file_fingerprint(config.get('hpo', 'obo')),
+                remove_from_stops=remove_from_stops,
+                stemmer=[stem_pattern, stem_min_length],
+                nltk_version=nltk.__version__,
+                )
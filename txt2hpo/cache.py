@@ -0,0 +1,112 @@
+import hashlib
+import json
+import os
+
+from txt2hpo.config import config, logger
+
+# files larger than this are identified by size and modification time rather than by hashing their content
+max_hashed_size = 64 * 2 ** 20
+
+# number of artifacts of other sources kept, e.g. of installs with other versions sharing the artifact directory
+max_stale_artifacts = 2
+
+_file_hashes = {}
+
+
+def file_fingerprint(path):
+    """
+    Identify the content of a file
+    :param path: path of file
+    :return: sha1 of content, or size and modification time of files larger than max_hashed_size
+    """
+    stat = os.stat(path)
+    if stat.st_size > max_hashed_size:
+        return f'{stat.st_size}-{stat.st_mtime_ns}'
+
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _file_hashes:
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as fh:
+            for block in iter(lambda: fh.read(2 ** 20), b''):
+                sha1.update(block)
+        _file_hashes[key] = sha1.hexdigest()
+    return _file_hashes[key]
+
+
+def artifact_key(sources):
+    """
+    Hash what an artifact is derived from
+    :param sources: json serializable description of sources, e.g. dictionary of file fingerprints and versions
+    :return: hex string
+    """
+    return hashlib.sha1(json.dumps(sources, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+
+
+def artifact_directory():
+    """directory of derived artifacts, the directory of the configured parsing tree"""
+    return os.path.dirname(config.get('tree', 'parsing_tree'))
+
+
+def artifact_path(name, key, extension, variant=None):
+    """
+    Path of an artifact derived from sources hashed to key
+    :param name: name of artifact
+    :param key: key of sources, from artifact_key
+    :param extension: file extension
+    :param variant: key of options the artifact is built with, several variants of current sources are kept
+    :return: path
+    """
+    if variant:
+        key = f'{key}-{variant}'
+    return os.path.join(artifact_directory(), f'{name}-{key}.{extension}')
+
+
+def collect_garbage(name, key, legacy=False, keep=None):
+    """
+    Remove artifacts derived from other sources than those hashed to key, but the most recently modified of them
+    :param name: name of artifact
+    :param key: key of current sources
+    :param legacy: also remove files of name without a key, saved before artifacts were keyed, e.g. the parsing tree
+    :param keep: number of artifacts of other sources kept, defaults to max_stale_artifacts
+    :return: list of removed paths
+    """
+    if keep is None:
+        keep = max_stale_artifacts
+    directory = artifact_directory()
+    legacy_paths = []
+    stale_paths = []
+    for file_name in os.listdir(directory):
+        base, extension = os.path.splitext(file_name)
+        path = os.path.join(directory, file_name)
+        if legacy and base == name:
+            legacy_paths.append(path)
+        elif base.startswith(f'{name}-') and not base[len(name) + 1:].startswith(key):
+            try:
+                stale_paths.append((os.path.getmtime(path), path))
+            except OSError:
+                continue
+
+    removed = []
+    stale_paths = [path for _, path in sorted(stale_paths, reverse=True)[keep:]]
+    for path in legacy_paths + stale_paths:
+        try:
+            os.remove(path)
+            removed.append(path)
+        except OSError as e:
+            logger.info(f'Could not remove stale {name}\n {e}')
+    if removed:
+        logger.info(f'Removed stale {name}: {removed}')
+    return removed
+
+
+def save_atomic(path, write):
+    """
+    Write a file through a temporary file, so readers never see it partially written
+    :param path: path of file
+    :param write: function writing to an open binary file handle
+    :return: None
+    """
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as fh:
+        write(fh)
+    os.replace(tmp_path, path)
@@ -0,0 +1,346 @@
+import json
+import mmap
+import os
+import struct
+import zlib
+
+import numpy as np
+
+MAGIC = b'TXT2HPO\x00'
+FORMAT_VERSION = 1
+
+# arrays are aligned in the file, so they can be viewed in place
+ALIGNMENT = 64
+
+
+class CompactTree(object):
+    """
+    Read-only search tree memory-mapped from a file written by write_compact_tree
+    Stems, phrase keys and HPO IDs are interned in string tables, phrases are laid out in flat offset arrays grouped by
+    root stem and phrase length, and stems and phrases are found through open addressing hash tables. Nothing is
+    unpickled, lookups only read the pages they touch, and processes mapping the same file share its pages.
+    The tree is used like the nested dictionary built by build_search_tree, tree[stem][length][key] -> list of hpids.
+    """
+
+    def __init__(self, path, max_cached_stems=100000):
+        self.path = path
+        with open(path, 'rb') as fh:
+            self._mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._mm[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path} is not a txt2hpo search tree')
+        header_length, = struct.unpack_from('<Q', self._mm, len(MAGIC))
+        header_start = len(MAGIC) + 8
+        self.header = json.loads(self._mm[header_start:header_start + header_length].decode('utf-8'))
+        if self.header['format_version'] != FORMAT_VERSION:
+            raise ValueError(f'{path} has search tree format {self.header["format_version"]}, '
+                             f'expected {FORMAT_VERSION}')
+
+        arrays = {}
+        for name, (dtype, offset, count) in self.header['arrays'].items():
+            arrays[name] = np.frombuffer(self._mm, dtype=dtype, count=count, offset=offset)
+        self._arrays = arrays
+        self._stems = _StringTable(self._mm, arrays['stem_offsets'], self.header['arrays']['stem_blob'][1])
+        self._keys = _StringTable(self._mm, arrays['key_offsets'], self.header['arrays']['key_blob'][1])
+        self._hpids = _StringTable(self._mm, arrays['hpid_offsets'], self.header['arrays']['hpid_blob'][1])
+
+        # roots looked up so far, including stems which are not in the tree
+        self._roots = {}
+        self.max_cached_stems = max_cached_stems
+
+    def root(self, stem):
+        """
+        Find phrases rooted at stem
+        :param stem: stemmed token
+        :return: _Root, None if stem is not in the tree
+        """
+        try:
+            return self._roots[stem]
+        except KeyError:
+            pass
+
+        stem_id = _find(self._arrays['stem_table'], stem.encode('utf-8', 'surrogatepass'), 0,
+                        lambda i, data: self._stems.bytes(i) == data)
+        root = _Root(self, stem_id, stem) if stem_id >= 0 else None
+        if len(self._roots) >= self.max_cached_stems:
+            self._roots = {}
+        self._roots[stem] = root
+        return root
+
+    def phrase(self, length_index, key):
+        """
+        Find HPO IDs of a phrase
+        :param length_index: position of phrase length among phrase lengths of all roots
+        :param key: sorted stems of phrase joined by spaces
+        :return: list of hpids, None if not found
+        """
+        first = int(self._arrays['length_phrase_offsets'][length_index])
+        last = int(self._arrays['length_phrase_offsets'][length_index + 1])
+        phrase_id = _find(self._arrays['phrase_table'], key.encode('utf-8', 'surrogatepass'), length_index,
+                          lambda i, data: first <= i < last and self._keys.bytes(i) == data)
+        if phrase_id < 0:
+            return None
+        return self.hpids(phrase_id)
+
+    def hpids(self, phrase_id):
+        """list of hpids of a phrase"""
+        offsets = self._arrays['phrase_hpid_offsets']
+        ids = self._arrays['phrase_hpids'][int(offsets[phrase_id]):int(offsets[phrase_id + 1])]
+        return [self._hpids.string(int(i)) for i in ids]
+
+    def __contains__(self, stem):
+        return self.root(stem) is not None
+
+    def __getitem__(self, stem):
+        root = self.root(stem)
+        if root is None:
+            raise KeyError(stem)
+        return root
+
+    def get(self, stem, default=None):
+        root = self.root(stem)
+        return default if root is None else root
+
+    def __len__(self):
+        return len(self._arrays['stem_offsets']) - 1
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._stems.string(i)
+
+    def keys(self):
+        return iter(self)
+
+    def values(self):
+        for stem, root in self.items():
+            yield root
+
+    def items(self):
+        for i in range(len(self)):
+            stem = self._stems.string(i)
+            yield stem, _Root(self, i, stem)
+
+    def close(self):
+        self._arrays = {}
+        self._roots = {}
+        self._stems = self._keys = self._hpids = None
+        self._mm.close()
+
+
+class _Root(object):
+    """Phrases rooted at a stem, keyed by number of stems in phrase"""
+
+    def __init__(self, tree, stem_id, stem):
+        self.tree = tree
+        self.stem_id = stem_id
+        self.stem = stem
+        offsets = tree._arrays['root_offsets']
+        self.first = int(offsets[stem_id])
+        self.lengths = tuple(int(x) for x in tree._arrays['root_lengths'][self.first:int(offsets[stem_id + 1])])
+
+    def __contains__(self, length):
+        return length in self.lengths
+
+    def __getitem__(self, length):
+        try:
+            return _Phrases(self.tree, self.first + self.lengths.index(length))
+        except ValueError:
+            raise KeyError(length)
+
+    def get(self, length, default=None):
+        return self[length] if length in self.lengths else default
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __iter__(self):
+        return iter(self.lengths)
+
+    def keys(self):
+        return iter(self.lengths)
+
+    def values(self):
+        for length in self.lengths:
+            yield self[length]
+
+    def items(self):
+        for length in self.lengths:
+            yield length, self[length]
+
+
+class _Phrases(object):
+    """Phrases of a root stem and length, keyed by their sorted stems joined by spaces"""
+
+    def __init__(self, tree, length_index):
+        self.tree = tree
+        self.length_index = length_index
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        hpids = self.tree.phrase(self.length_index, key)
+        if hpids is None:
+            raise KeyError(key)
+        return hpids
+
+    def get(self, key, default=None):
+        hpids = self.tree.phrase(self.length_index, key)
+        return default if hpids is None else hpids
+
+    def _range(self):
+        offsets = self.tree._arrays['length_phrase_offsets']
+        return range(int(offsets[self.length_index]), int(offsets[self.length_index + 1]))
+
+    def __len__(self):
+        return len(self._range())
+
+    def __iter__(self):
+        for i in self._range():
+            yield self.tree._keys.string(i)
+
+    def keys(self):
+        return iter(self)
+
+    def values(self):
+        for i in self._range():
+            yield self.tree.hpids(i)
+
+    def items(self):
+        for i in self._range():
+            yield self.tree._keys.string(i), self.tree.hpids(i)
+
+
+class _StringTable(object):
+    """utf-8 strings stored back to back in a blob, located by an array of offsets"""
+
+    def __init__(self, mm, offsets, blob_offset):
+        self.mm = mm
+        self.offsets = offsets
+        self.blob_offset = blob_offset
+
+    def bytes(self, i):
+        return self.mm[self.blob_offset + int(self.offsets[i]):self.blob_offset + int(self.offsets[i + 1])]
+
+    def string(self, i):
+        return self.bytes(i).decode('utf-8', 'surrogatepass')
+
+
+def _hash(data, seed):
+    return zlib.crc32(data, seed & 0xffffffff)
+
+
+def _find(table, data, seed, matches):
+    """probe open addressing hash table for data, return id of matching entry or -1"""
+    mask = len(table) - 1
+    slot = _hash(data, seed) & mask
+    while True:
+        entry = int(table[slot])
+        if entry < 0:
+            return -1
+        if matches(entry, data):
+            return entry
+        slot = (slot + 1) & mask
+
+
+def _hash_table(items):
+    """
+    Build open addressing hash table
+    :param items: list of tuples (bytes, seed), position in list is the id stored in the table
+    :return: int32 array of ids, -1 for empty slots
+    """
+    size = 1
+    while size < 2 * len(items):
+        size *= 2
+    table = np.full(size, -1, dtype=np.int32)
+    mask = size - 1
+    for i, (data, seed) in enumerate(items):
+        slot = _hash(data, seed) & mask
+        while table[slot] >= 0:
+            slot = (slot + 1) & mask
+        table[slot] = i
+    return table
+
+
+def _string_table(strings):
+    """encode strings into a blob and an array of offsets"""
+    encoded = [x.encode('utf-8', 'surrogatepass') for x in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.uint32)
+    offsets[1:] = np.cumsum([len(x) for x in encoded])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets, encoded
+
+
+def write_compact_tree(search_tree, path, header=None):
+    """
+    Write search tree to a compact binary file, read with CompactTree
+    :param search_tree: nested dictionary built by build_search_tree
+    :param path: path of file, replaced atomically
+    :param header: dictionary of provenance stored in the file header, e.g. versions of ontology and models
+    :return: None
+    """
+    stems = list(search_tree)
+    hpid_ids = {}
+    root_offsets = [0]
+    root_lengths = []
+    length_phrase_offsets = [0]
+    keys = []
+    phrase_hpid_offsets = [0]
+    phrase_hpids = []
+    phrase_hashes = []
+
+    for stem in stems:
+        for length in sorted(search_tree[stem]):
+            root_lengths.append(length)
+            for key, hpids in search_tree[stem][length].items():
+                keys.append(key)
+                phrase_hashes.append((key.encode('utf-8', 'surrogatepass'), len(root_lengths) - 1))
+                for hpid in hpids:
+                    phrase_hpids.append(hpid_ids.setdefault(hpid, len(hpid_ids)))
+                phrase_hpid_offsets.append(len(phrase_hpids))
+            length_phrase_offsets.append(len(keys))
+        root_offsets.append(len(root_lengths))
+
+    stem_blob, stem_offsets, encoded_stems = _string_table(stems)
+    key_blob, key_offsets, _ = _string_table(keys)
+    hpid_blob, hpid_offsets, _ = _string_table(list(hpid_ids))
+
+    arrays = dict(
+        stem_blob=stem_blob,
+        stem_offsets=stem_offsets,
+        stem_table=_hash_table([(x, 0) for x in encoded_stems]),
+        root_offsets=np.array(root_offsets, dtype=np.uint32),
+        root_lengths=np.array(root_lengths, dtype=np.uint16),
+        length_phrase_offsets=np.array(length_phrase_offsets, dtype=np.uint32),
+        key_blob=key_blob,
+        key_offsets=key_offsets,
+        phrase_table=_hash_table(phrase_hashes),
+        phrase_hpid_offsets=np.array(phrase_hpid_offsets, dtype=np.uint32),
+        phrase_hpids=np.array(phrase_hpids, dtype=np.uint32),
+        hpid_blob=hpid_blob,
+        hpid_offsets=hpid_offsets,
+    )
+
+    header = dict(header or {}, format_version=FORMAT_VERSION)
+
+    # lay out arrays after the header, header size depends on the offsets so reserve enough room for them
+    layout = {}
+    reserved = len(json.dumps(dict(header, arrays={name: ['<u4', 10 ** 12, 10 ** 12] for name in arrays})))
+    offset = _align(len(MAGIC) + 8 + reserved)
+    for name, array in arrays.items():
+        layout[name] = [array.dtype.str, offset, int(array.size)]
+        offset = _align(offset + array.nbytes)
+    header_bytes = json.dumps(dict(header, arrays=layout)).encode('utf-8')
+
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as fh:
+        fh.write(MAGIC)
+        fh.write(struct.pack('<Q', len(header_bytes)))
+        fh.write(header_bytes)
+        for name, array in arrays.items():
+            fh.write(b'\x00' * (layout[name][1] - fh.tell()))
+            fh.write(array.tobytes())
+    os.replace(tmp_path, path)
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
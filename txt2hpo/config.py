@@ -3,7 +3,6 @@ import logging
 import os
 import requests
 
-from gensim.models import KeyedVectors
 from txt2hpo import __project__, __version__
 
 # create logger
@@ -56,8 +55,10 @@ if not os.path.isfile(os.path.join(config_directory, 'txt2hpo.ini')):
     config['models'] = {}
     d2v_path = os.path.join(os.path.dirname(__file__), 'data/doc2vec_dm0_tagUniq_ep51_sa1e-05_vs40_ws18_mc5_neg5.wv.gz')
     d2v_vw_path = os.path.join(data_directory, 'doc2vec.wv')
+    from gensim.models import KeyedVectors
     wv = KeyedVectors.load(d2v_path)
-    wv.save(d2v_vw_path)
+    # arrays are saved in separate files, so they can be memory-mapped
+    wv.save(d2v_vw_path, sep_limit=0)
     config['models']['doc2vec'] = d2v_vw_path
 
     config['hpo'] = {}
@@ -1,12 +1,38 @@
 import json
-from gensim.models import KeyedVectors
-from txt2hpo.config import config
+import os
+from txt2hpo.config import config, logger
+
+# doc2vec vectors, loaded on first use
+_model = None
 
 
 def load_model():
+    """
+    Load doc2vec vectors memory-mapped read-only, so processes loading them share one copy in the page cache
+    Vectors saved with their arrays inside the pickle are re-saved once with the arrays in separate .npy files. They
+    are saved under a temporary name and moved into place, so processes loading them meanwhile never see partial files.
+    :return: KeyedVectors
+    """
+    from gensim.models import KeyedVectors
+    global _model
+    if _model is not None:
+        return _model
+
     if 'doc2vec' in config['models']:
-        wv = KeyedVectors.load(config['models']['doc2vec'])
-    return wv
+        path = config['models']['doc2vec']
+        if not os.path.isfile(path + '.vectors.npy'):
+            logger.info('Saving doc2vec vectors for memory mapping, this is a one time thing \n')
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            KeyedVectors.load(path).save(tmp_path, sep_limit=0)
+
+            # arrays are moved before the pickle referring to them, the old pickle still loads with them in place
+            directory, tmp_name = os.path.split(tmp_path)
+            for file_name in os.listdir(directory or '.'):
+                if file_name.startswith(f'{tmp_name}.'):
+                    os.replace(os.path.join(directory, file_name), path + file_name[len(tmp_name):])
+            os.replace(tmp_path, path)
+        _model = KeyedVectors.load(path, mmap='r')
+    return _model
 
 
 def load_spellcheck_vocab():
@@ -1,17 +1,21 @@
 import json
 import numpy as np
-from itertools import combinations, chain
+from collections import Counter
+from itertools import combinations, chain, islice
 import spacy
 import re
+from spacy.tokens import Span
 
-from txt2hpo.build_tree import update_progress, hpo_network
+from txt2hpo.build_tree import update_progress
 from txt2hpo.config import logger
-from txt2hpo.spellcheck import spellcheck
-from txt2hpo.nlp import nlp_model, nlp_sans_ner, similarity_term_to_context
-from txt2hpo.nlp import st
+from txt2hpo.spellcheck import spellcheck_doc
+from txt2hpo.nlp import nlp_model, load_term_vectors
+from txt2hpo.nlp import stem_token, negation_cache
 from txt2hpo.data import load_model
-from txt2hpo.build_tree import search_tree, build_search_tree
-from txt2hpo.util import remove_key, non_phenos
+from txt2hpo.build_tree import build_overlay_tree, OverlayTree
+from txt2hpo.matcher import compile_matcher
+from txt2hpo.util import remove_key, term_mask, combine_masks, unmasked_hpids
+from txt2hpo import resources
 
 
 class Data(object):
@@ -40,9 +44,10 @@ class Data(object):
             self.negated_entries.append(element)
 
     def detect_negation(self):
-        for entry in self.entries:
-            entry['negated_tokens'] = ' '.join([e.text for e in self.negation_model(entry['context']).ents if e._.negex])
-            entry['negated'] = [t.text for t in nlp_sans_ner(entry['negated_tokens'])]
+        negations = negation_cache(self.negation_model, [entry['context'] for entry in self.entries])
+        for entry, (negated_tokens, negated) in zip(self.entries, negations):
+            entry['negated_tokens'] = negated_tokens
+            entry['negated'] = negated
             if isinstance(entry['matched_tokens'], (spacy.tokens.doc.Doc, spacy.tokens.span.Span)):
                 entry['matched_words'] = [t.text for t in entry['matched_tokens']]
             elif isinstance(entry['matched_tokens'], spacy.tokens.token.Token):
@@ -52,12 +57,11 @@ class Data(object):
             entry['is_negated'] = True if set(entry['negated']).intersection(set(entry['matched_words'])) else False
 
     def label_terms(self):
-        for entry in self.entries:
-            for hpid in entry['hpid']:
-                if hpid in non_phenos:
-                    entry['type'] = non_phenos[hpid]
-                else:
-                    entry['type'] = 'phenotype'
+        # entries are labeled by their last hpid
+        labeled = [entry for entry in self.entries if entry['hpid']]
+        types = resources.get('ontology').term_types([entry['hpid'][-1] for entry in labeled])
+        for entry, term_type in zip(labeled, types):
+            entry['type'] = term_type
 
     def remove_non_phenos(self):
         self.remove_tagged('type', state='phenotype', status=False)
@@ -97,38 +101,63 @@ class Data(object):
                 rec['is_longest'] = False
             self.entries[i] = rec
 
-    def resolve_conflicts(self):
+    def resolve_conflicts(self, top_k=1, min_score=None, keep_scores=False):
         """
-        Pick most likely HPO ID based on context
-        :param extracted_terms: list of dictionaries identified by extract_hpo_terms
-        :return: list of dictionaries with resolved conflicts
+        Rank HPO IDs of each entry by similarity to context, keep the most likely
+        :param top_k: number of most likely HPO IDs to keep, None to keep all
+        :param min_score: drop HPO IDs less similar to context than min_score, the most likely one is always kept
+        :param keep_scores: add similarity scores of kept HPO IDs to entries, in the same order, under 'scores'
+        :return: modify self.entries, HPO IDs of each entry sorted from most to least likely
         """
         if not self.model:
             logger.critical("Doc2vec model does not exist or could not be loaded")
 
-        resolved_terms = []
-        for entry in self.entries:
-            similarity_scores = []
-            if len(entry['hpid']) > 1:
-                for term in entry['hpid']:
-                    similarity_scores.append(similarity_term_to_context(term, entry['context'], self.model))
-
-                # reduce matches until only one term left
-                for i in range(len(similarity_scores) - 1):
-                    idx_least_likely_term = similarity_scores.index(min(similarity_scores))
-                    least_likely_term = entry['hpid'][idx_least_likely_term]
-                    entry['hpid'].remove(least_likely_term)
-
-            resolved_terms.append(entry)
-        self.entries = resolved_terms
+        # unambiguous entries are only scored when scores are reported
+        if keep_scores:
+            ranked = self.entries
+        else:
+            ranked = [entry for entry in self.entries if len(entry['hpid']) > 1]
+        if not ranked:
+            return
+
+        # score all terms of the document at once
+        term_vectors = load_term_vectors(self.model)
+        scores = term_vectors.similarity([(entry['hpid'], entry['context']) for entry in ranked], self.model)
+
+        for entry, similarity_scores in zip(ranked, scores):
+            # most likely first, the later one first if several are equally likely
+            order = np.lexsort((-np.arange(len(similarity_scores)), -similarity_scores))[:top_k]
+            if min_score is not None:
+                order = order[:1].tolist() + [i for i in order[1:] if similarity_scores[i] >= min_score]
+            entry['hpid'] = [entry['hpid'][i] for i in order]
+            if keep_scores:
+                entry['scores'] = [float(similarity_scores[i]) for i in order]
+
+    def propagate(self, levels=None, roots=None, unique=True):
+        """
+        Count extracted terms and their ancestors, e.g. to roll terms up to organ systems
+        :param levels: max number of is_a steps terms are propagated up, None to propagate up to the root
+        :param roots: list of hpo ids to report, e.g. organ systems, all terms if None
+        :param unique: count each extracted hpo id once, otherwise count every entry it is found in
+        :return: tuple of sorted array of indices of terms in the ontology, array of their propagated counts
+        """
+        ontology = resources.get('ontology')
+        if unique:
+            hpids = self.hpids
+        else:
+            hpids = chain.from_iterable(x['hpid'] for x in self.entries)
+        indices = [ontology.index[x] for x in hpids if x in ontology.index]
+        if roots is not None:
+            roots = [ontology.index[x] for x in roots if x in ontology.index]
+        return ontology.propagate(indices, levels=levels, roots=roots)
 
     @property
     def hpids(self):
-        return list(set(np.array([x['hpid'] for x in self.entries]).flatten()))
+        return list(set(chain.from_iterable(x['hpid'] for x in self.entries)))
 
     @property
     def negated_hpids(self):
-        return list(set(np.array([x['hpid'] for x in self.negated_entries]).flatten()))
+        return list(set(chain.from_iterable(x['hpid'] for x in self.negated_entries)))
 
     @property
     def json(self):
@@ -159,12 +188,33 @@ class Extractor:
     """ Converts text to HPO annotated JSON object
 
     Args:
-        correct_spelling: (True,False) attempt to correct spelling using spellcheck
+        correct_spelling: (True,False) attempt to correct spelling using spellcheck, words which are roots of the search
+                          tree are left as they are
         max_neighbors: (int) max number of phenotypic groups to attempt to search for a matching phenotype
         max_length: (int) max document length in characters, higher limit will require more memory
         context_window: (int) dimensions of context to return number of tokens in each direction
-        resolve_conflicts: (True,False) loads big model
+        resolve_conflicts: (True,False) loads big model, on first use
+        model: doc2vec model used to resolve conflicts, defaults to the memory-mapped txt2hpo model
         custom_synonyms: (dict) dictionary of additional synonyms to map
+        chunk_by: (phrase,max_length) split text into phrases or chunks of max_length characters
+        parse_once: (True,False) tokenize each document once and extract from phrase slices of it, requires
+                    chunk_by='phrase'
+        engine: (tree,automaton) match phrases by combining groups of phenotype tokens and probing the search tree,
+                or in a single pass with a phrase matcher over the search tree
+        max_candidates: (int) max number of distinct phrases probed in the search tree per chunk, and of fused groups
+                        of phenotype tokens they are drawn from, None for no limit. Capping drops matches: phrases
+                        are probed from left to right, chunks hitting the limit are counted in
+                        candidate_stats['capped_chunks'], chunks with truncated fused groups in
+                        candidate_stats['capped_fused'], see extract_corpus for parallel runs
+        original_offsets: (True,False) report index and matched string in the original text rather than in the spell
+                          corrected text
+        top_k: (int) number of most likely HPO IDs kept per term when resolving conflicts, None to keep all ranked
+        min_score: (float) drop HPO IDs less similar to context than min_score when resolving conflicts, the most
+                   likely HPO ID is always kept
+        keep_scores: (True,False) report similarity scores of kept HPO IDs under 'scores' when resolving conflicts
+        masked_terms: (list) HPO IDs never reported, in addition to those masked in each call to hpo
+        masked_subtrees: (list) HPO IDs never reported along with their descendants, in addition to those masked in
+                         each call to hpo
 
     """
 
@@ -180,10 +230,22 @@ class Extractor:
                  negation_language="en",
                  chunk_by='phrase',
                  phenotypes_only=True,
+                 parse_once=False,
+                 engine='tree',
+                 max_candidates=None,
+                 original_offsets=False,
+                 top_k=1,
+                 min_score=None,
+                 keep_scores=False,
+                 masked_terms=None,
+                 masked_subtrees=None,
                  ):
 
         self.correct_spelling = correct_spelling
         self.resolve_conflicts = resolve_conflicts
+        self.top_k = top_k
+        self.min_score = min_score
+        self.keep_scores = keep_scores
         self.remove_negated = remove_negated
         self.remove_overlapping = remove_overlapping
         self.max_neighbors = max_neighbors
@@ -191,72 +253,186 @@ class Extractor:
         self.context_window = context_window
         self.negation_model = nlp_model(negation_language=negation_language)
         self.chunk_by = chunk_by
+        self.parse_once = parse_once
+        self.engine = engine
+        self.max_candidates = max_candidates
+        self.candidate_stats = Counter()
+        self.original_offsets = original_offsets
         self.phenotypes_only = phenotypes_only
+        self.term_mask = term_mask(masked_terms, masked_subtrees)
         if custom_synonyms:
-            self.search_tree = build_search_tree(custom_synonyms=custom_synonyms)
+            self.search_tree = OverlayTree(resources.get('search_tree'), build_overlay_tree(custom_synonyms))
         else:
-            self.search_tree = search_tree
-        if model is None:
-            self.model = load_model()
+            self.search_tree = resources.get('search_tree')
+        if self.engine == 'automaton':
+            self.matcher = compile_matcher(self.search_tree)
+        self._model = model
 
-    def hpo(self, text):
+    @property
+    def model(self):
+        """doc2vec model used to resolve conflicts, loaded on first use"""
+        if self._model is None:
+            self._model = load_model()
+        return self._model
+
+    @property
+    def data_model(self):
+        """model passed to extracted Data, None unless conflicts are resolved so vectors are never loaded"""
+        return self.model if self.resolve_conflicts else None
+
+    def hpo(self, text, masked_terms=None, masked_subtrees=None):
         """
         extracts hpo terms from text
         :param text: text of type string
+        :param masked_terms: list of HPO IDs not to report
+        :param masked_subtrees: list of HPO IDs not to report along with their descendants
         :return: Data object
         """
+        return next(self.hpo_batch([text], masked_terms=masked_terms, masked_subtrees=masked_subtrees))
+
+    def hpo_batch(self, texts, batch_size=50, masked_terms=None, masked_subtrees=None):
+        """
+        extracts hpo terms from many texts, streaming their chunks through spaCy in batches
+        Masked HPO IDs are dropped from matched phrases, phrases left without HPO IDs are not reported.
+        :param texts: iterable of strings
+        :param batch_size: number of texts to tokenize together
+        :param masked_terms: list of HPO IDs not to report
+        :param masked_subtrees: list of HPO IDs not to report along with their descendants
+        :return: generator of Data objects, one per text, in input order
+        """
 
+        mask = combine_masks(self.term_mask, term_mask(masked_terms, masked_subtrees))
+        nlp_sans_ner = resources.get('nlp_sans_ner')
         nlp_sans_ner.max_length = self.max_length
 
-        extracted_terms = Data(model=self.model, negation_model=self.negation_model)
+        texts = iter(texts)
+        while True:
+            batch = list(islice(texts, batch_size))
+            if not batch:
+                break
 
-        len_last_chunk = 0
+            chunked = [self._chunk_text(text) for text in batch]
+            docs = nlp_sans_ner.pipe([chunk for chunks, _ in chunked for chunk in chunks])
 
-        if self.chunk_by == "max_length":
+            for chunks, chunk_mode in chunked:
+                extracted_terms = Data(model=self.data_model, negation_model=self.negation_model)
+                self._extract_chunks(chunks, docs, chunk_mode, extracted_terms, mask)
+                yield self._post_process(extracted_terms)
 
-            chunks = [text[i:i + self.max_length] for i in range(0, len(text), self.max_length)]
-        elif self.chunk_by == "phrase":
-            chunks = re.split(";|,|\n|\r|\.", text)
+    def _extract_chunks(self, chunks, docs, chunk_mode, extracted_terms, mask=None):
+        """
+        extract hpo terms from the chunks of a text
+        :param chunks: list of chunks of text, output of _chunk_text
+        :param docs: iterator of spaCy docs, the next len(chunks) of which are the tokenized chunks
+        :param chunk_mode: max_length, phrase or document, output of _chunk_text
+        :param extracted_terms: Data object the extracted terms are added to
+        :param mask: boolean array of masked HPO IDs from term_mask, or None
+        """
+        base_index = 0
+        for chunk, source_tokens in zip(chunks, docs):
 
-        for i, chunk in enumerate(chunks):
+            # tokens joining words of two phrases are split, as if each phrase was tokenized on its own
+            if chunk_mode == 'document':
+                split_phrase_tokens(source_tokens)
 
+            # spelling is corrected token by token, without tokenizing the chunk again
             if self.correct_spelling:
-                chunk = spellcheck(chunk)
+                tokens = spellcheck_doc(source_tokens, skip=self.search_tree)
+            else:
+                tokens = source_tokens
+            if tokens is source_tokens or not self.original_offsets:
+                source_tokens = None
+
+            if chunk_mode == 'document':
+                for phrase_tokens in phrase_spans(tokens, split_phrases(tokens.text)):
+                    if source_tokens is not None:
+                        source_phrase_tokens = source_tokens[phrase_tokens.start:phrase_tokens.end]
+                    else:
+                        source_phrase_tokens = None
+                    extracted_terms.add(self._extract_chunk(phrase_tokens, 0, source_phrase_tokens, mask))
+                continue
 
-            tokens = nlp_sans_ner(chunk)
+            extracted_terms.add(self._extract_chunk(tokens, base_index, source_tokens, mask))
 
-            # Stem tokens
-            stemmed_tokens = [st.stem(st.stem(x.lemma_.lower())) for x in tokens]
+            # keep track of chunked coordinates, split character len=1
+            base_index += len(tokens.text if source_tokens is None else source_tokens.text)
+            if chunk_mode == 'phrase':
+                base_index += 1
 
-            # Index tokens which match stemmed phenotypes
-            phenotokens, phenindeces = self.index_tokens(stemmed_tokens)
+    def _chunk_text(self, text):
+        """
+        split text into chunks
+        :param text: text of type string
+        :return: tuple of list of chunks, chunk mode (max_length, phrase or document)
+        """
+        if self.chunk_by == "max_length":
+            return [text[i:i + self.max_length] for i in range(0, len(text), self.max_length)], 'max_length'
 
-            # Group token indices
-            groups = group_sequence(phenindeces)
+        elif self.chunk_by == "phrase":
+            if self.parse_once and len(text) <= self.max_length:
+                # whole document is tokenized at once, phrases are sliced from the doc
+                return [text], 'document'
+            return re.split(";|,|\n|\r|\.", text), 'phrase'
 
-            # Add leave one out groups
-            groups = permute_leave_one_out(groups)
+    def _extract_chunk(self, tokens, base_index, source_tokens=None, mask=None):
+        """
+        extract hpo terms from a tokenized chunk
+        :param tokens: spaCy doc of chunk, or span of a doc
+        :param base_index: character offset of chunk in text
+        :param source_tokens: tokens of the original chunk when tokens are spell corrected, used for offsets
+        :param mask: boolean array of masked HPO IDs from term_mask, or None
+        :return: list of dictionaries
+        """
+
+        # Stem tokens
+        stemmed_tokens = [stem_token(x) for x in tokens]
 
-            # Find and fuse adjacent phenotype groups
-            assembled_groups = assemble_groups(groups, max_distance=self.max_neighbors)
+        if self.engine == 'automaton':
+            return self.match_hpo_terms(tuple(stemmed_tokens), tokens, base_index, source_tokens, mask)
 
-            phen_groups = recombine_groups(assembled_groups)
+        # Index tokens which match stemmed phenotypes
+        phenotokens, phenindeces = self.index_tokens(stemmed_tokens)
 
-            # Extract hpo terms keep track of chunked coordinates, split character len=1
+        # Group token indices
+        groups = group_sequence(phenindeces)
 
-            extracted_terms.add(self.find_hpo_terms(tuple(phen_groups),
-                                              tuple(stemmed_tokens),
-                                              tokens,
-                                              base_index=len_last_chunk,
-                                              ))
-            if self.chunk_by == 'phrase':
-                len_last_chunk += len(chunk) + 1
-            elif self.chunk_by == 'max_length':
-                len_last_chunk += len(chunk)
+        # Add leave one out groups
+        groups = permute_leave_one_out(groups)
+
+        # Find and fuse adjacent phenotype groups, up to max_candidates fused groups, as assemble_groups
+        fused_groups = iter_fused_groups(groups, max_distance=self.max_neighbors)
+        if self.max_candidates is not None:
+            fused_groups = list(islice(fused_groups, self.max_candidates + 1))
+            if len(fused_groups) > self.max_candidates:
+                fused_groups = fused_groups[:self.max_candidates]
+                self.candidate_stats['capped_fused'] += 1
+        if self.max_neighbors < 2:
+            assembled_groups = set()
+        else:
+            assembled_groups = set(tuple(set(x)) for x in groups).union(fused_groups)
+
+        # Generate unique candidate groups, from left to right when they are capped
+        if self.max_candidates is not None:
+            assembled_groups = sorted(assembled_groups, key=group_indices)
+        phen_groups = iter_recombined_groups(assembled_groups)
+        self.candidate_stats['chunks'] += 1
+
+        # Extract hpo terms keep track of chunked coordinates, split character len=1
+        return self.find_hpo_terms(phen_groups,
+                                   tuple(stemmed_tokens),
+                                   tokens,
+                                   base_index=base_index,
+                                   source_tokens=source_tokens,
+                                   mask=mask,
+                                   )
+
+    def _post_process(self, extracted_terms):
+        """Resolve conflicts, remove negated, overlapping and non-phenotype terms"""
 
         if extracted_terms:
             if self.resolve_conflicts is True:
-                extracted_terms.resolve_conflicts()
+                extracted_terms.resolve_conflicts(top_k=self.top_k, min_score=self.min_score,
+                                                  keep_scores=self.keep_scores)
             else:
                 pass
 
@@ -272,17 +448,46 @@ class Extractor:
 
         return extracted_terms
 
-    def find_hpo_terms(self, phen_groups, stemmed_tokens, tokens, base_index):
-        """Match hpo terms from stemmed tree to indexed groups in text"""
+    def find_hpo_terms(self, phen_groups, stemmed_tokens, tokens, base_index, source_tokens=None, mask=None):
+        """Match hpo terms from stemmed tree to indexed groups in text, up to max_candidates distinct phrases"""
         extracted_terms = []
 
+        # token indices are relative to the start of tokens, which may be a span of a larger doc
+        offset = tokens.start if isinstance(tokens, Span) else 0
+
         # remove stop words and punctuation from group of phenotypes
-        stop_punct_mask = [x.i for x in tokens if x.is_stop or x.is_punct]
+        stop_punct_mask = set(x.i - offset for x in tokens if x.is_stop or x.is_punct)
+
+        # number of remaining words before each token
+        n_words = [0]
+        for x in tokens:
+            n_words.append(n_words[-1] + (x.i - offset not in stop_punct_mask))
+
         cln_phen_groups = []
+        seen_spans = set()
         for grp in phen_groups:
             cand_grp = [x for x in grp if not x in stop_punct_mask]
-            if cand_grp:
-                cln_phen_groups.append(cand_grp)
+            if not cand_grp:
+                continue
+
+            # groups spanning the same tokens yield the same phrase
+            span = (min(cand_grp), max(cand_grp))
+            if span in seen_spans:
+                continue
+            seen_spans.add(span)
+
+            # skip groups whose number of words is not a phrase length of their root
+            if n_words[span[1] + 1] - n_words[span[0]] not in self.search_tree.get(stemmed_tokens[span[0]], ()):
+                self.candidate_stats['pruned'] += 1
+                continue
+
+            if self.max_candidates is not None and len(cln_phen_groups) >= self.max_candidates:
+                self.candidate_stats['capped_chunks'] += 1
+                logger.info(f'Candidate groups capped at {self.max_candidates} in a chunk of {len(tokens)} tokens')
+                break
+
+            cln_phen_groups.append(cand_grp)
+        self.candidate_stats['candidates'] += len(cln_phen_groups)
 
         for phen_group in cln_phen_groups:
 
@@ -297,7 +502,7 @@ class Extractor:
                 phen_stop = max(phen_group) + 1
                 phen_group_tokens = tokens[phen_start:phen_stop]
                 phen_group_tokens_minus_trash = [x for x in phen_group_tokens if not x.is_stop and not x.is_punct]
-                phen_group_tokens_minus_trash_idx = [x.i for x in phen_group_tokens_minus_trash]
+                phen_group_tokens_minus_trash_idx = [x.i - offset for x in phen_group_tokens_minus_trash]
                 phen_group_strings = [stemmed_tokens[x] for x in phen_group_tokens_minus_trash_idx] #phen_group_tokens_minus_trash_idx
 
             try_term_key = ' '.join(sorted(phen_group_strings))
@@ -310,51 +515,85 @@ class Extractor:
             except (KeyError, IndexError):
                 hpids = []
 
+            hpids = unmasked_hpids(hpids, mask)
+
             # if found any hpids, append to extracted
             if hpids:
-                # extract span of just matching phenotype tokens
-                matching_tokens_index = [x.i for x in tokens if x.i in phen_group]
+                found_term = self._found_term(phen_group, hpids, tokens, base_index, source_tokens)
+                if found_term not in extracted_terms:
+                    extracted_terms.append(found_term)
 
-                if len(matching_tokens_index) == 1:
-                    matched_tokens = tokens[matching_tokens_index[0]]
-                    matched_string = matched_tokens.text
-                    start = matched_tokens.idx
-                    end = start + len(matched_string)
+        return extracted_terms
 
-                else:
-                    matched_tokens = tokens[min(matching_tokens_index):max(matching_tokens_index) + 1]
-                    matched_string = matched_tokens.text
-                    start = matched_tokens.start_char
-                    end = matched_tokens.end_char
+    def match_hpo_terms(self, stemmed_tokens, tokens, base_index, source_tokens=None, mask=None):
+        """Match hpo terms in a single pass with the phrase matcher"""
+        extracted_terms = []
 
-                if min(matching_tokens_index) < self.context_window:
-                    context_start = 0
-                else:
-                    context_start = min(matching_tokens_index) - self.context_window
+        is_content = [not x.is_stop and not x.is_punct for x in tokens]
+        for phen_group, hpids in self.matcher.match(stemmed_tokens, is_content, max_neighbors=self.max_neighbors):
+            hpids = unmasked_hpids(hpids, mask)
+            if not hpids:
+                continue
+            # copy matching hpids, because we may need to delete conflicting terms without affecting this obj
+            found_term = self._found_term(phen_group, hpids.copy(), tokens, base_index, source_tokens)
+            if found_term not in extracted_terms:
+                extracted_terms.append(found_term)
 
-                if max(matching_tokens_index) + self.context_window >= len(tokens) - 1:
-                    context_end = len(tokens)
+        return extracted_terms
 
-                else:
-                    context_end = max(matching_tokens_index) + self.context_window
+    def _found_term(self, phen_group, hpids, tokens, base_index, source_tokens=None):
+        """Describe the span, matched string and context of a phenotype group matching hpids"""
 
-                if context_start == context_end:
-                    context = tokens[context_start]
+        # token indices are relative to the start of tokens, which may be a span of a larger doc
+        offset = tokens.start if isinstance(tokens, Span) else 0
 
-                else:
-                    context = tokens[context_start:context_end]
+        # extract span of just matching phenotype tokens
+        matching_tokens_index = [x.i - offset for x in tokens if x.i - offset in phen_group]
 
-                found_term = dict(hpid=hpids,
-                                  index=[base_index + start, base_index + end],
-                                  matched=matched_string,
-                                  context=context.text,
-                                  matched_tokens=matched_tokens,
-                                  )
+        if len(matching_tokens_index) == 1:
+            matched_tokens = tokens[matching_tokens_index[0]]
+            matched_string = matched_tokens.text
+            start = matched_tokens.idx
+            end = start + len(matched_string)
 
-                if found_term not in extracted_terms:
-                    extracted_terms.append(found_term)
+        else:
+            matched_tokens = tokens[min(matching_tokens_index):max(matching_tokens_index) + 1]
+            matched_string = matched_tokens.text
+            start = matched_tokens.start_char
+            end = matched_tokens.end_char
+
+        # report span and matched string in the original, uncorrected text
+        if source_tokens is not None:
+            matched_source = source_tokens[min(matching_tokens_index):max(matching_tokens_index) + 1]
+            matched_string = matched_source.text
+            start = matched_source.start_char
+            end = matched_source.end_char
+
+        if min(matching_tokens_index) < self.context_window:
+            context_start = 0
+        else:
+            context_start = min(matching_tokens_index) - self.context_window
 
-        return extracted_terms
+        if max(matching_tokens_index) + self.context_window >= len(tokens) - 1:
+            context_end = len(tokens)
+
+        else:
+            context_end = max(matching_tokens_index) + self.context_window
+
+        if context_start == context_end:
+            context = tokens[context_start]
+
+        else:
+            context = tokens[context_start:context_end]
+
+        found_term = dict(hpid=hpids,
+                          index=[base_index + start, base_index + end],
+                          matched=matched_string,
+                          context=context.text,
+                          matched_tokens=matched_tokens,
+                          )
+
+        return found_term
 
     def index_tokens(self, stemmed_tokens):
         """index phenotype tokens by matching each stem against root of search tree"""
@@ -368,6 +607,59 @@ class Extractor:
         return phenotokens, phenindices
 
 
+def split_phrases(text):
+    """
+    Find character spans of phrases in text
+    :param text: text of type string
+    :return: list of tuples (start, end) character offsets
+    """
+    phrases = []
+    start = 0
+    for phrase in re.split(";|,|\n|\r|\.", text):
+        phrases.append((start, start + len(phrase)))
+        start += len(phrase) + 1
+    return phrases
+
+
+def split_phrase_tokens(doc):
+    """
+    Split tokens joining words of two phrases, like hypotonia.seizures, 3.5 or e.g., into the tokens of each phrase
+    and their separators
+    :param doc: spaCy doc, split in place
+    :return: doc
+    """
+    tokenizer = resources.get('nlp_sans_ner').tokenizer
+    with doc.retokenize() as retokenizer:
+        for token in doc:
+            if len([x for x in re.split(";|,|\n|\r|\.", token.text) if x.strip()]) < 2:
+                continue
+            pieces = [x for x in re.split("(;|,|\n|\r|\.)", token.text) if x]
+            orths = [x.text for piece in pieces for x in tokenizer(piece)]
+            retokenizer.split(token, orths, heads=[(token, i) for i in range(len(orths))])
+    return doc
+
+
+def phrase_spans(doc, phrases):
+    """
+    Map character spans of phrases onto spans of tokens, tokens crossing a phrase boundary are dropped, see
+    split_phrase_tokens
+    :param doc: spaCy doc
+    :param phrases: list of tuples (start, end) character offsets
+    :return: list of spaCy spans
+    """
+    spans = []
+    i = 0
+    for start, end in phrases:
+        while i < len(doc) and doc[i].idx < start:
+            i += 1
+        j = i
+        while j < len(doc) and doc[j].idx + len(doc[j]) <= end:
+            j += 1
+        spans.append(doc[i:j])
+        i = j
+    return spans
+
+
 def group_sequence(lst):
     """
     Break a sequence of integers into continuous groups
@@ -386,45 +678,51 @@ def group_sequence(lst):
     return grouped
 
 
-def assemble_groups(original, max_distance=2, min_compl=0.20):
+def assemble_groups(original, max_distance=2, min_compl=0.20, max_fused=None):
     """
     Join adjacent groups of phenotypes into new groups
     [[1,2],[5,6]] -> {((1, 2), (5, 6)), (1, 2), (5, 6)}
     :param original: Original list of lists of integers
     :param max_distance: Maximum number of combinations
     :param min_compl: Minimum fraction of complete term
+    :param max_fused: Maximum number of joined groups to add
     :return: set of grouped tuple index sequences
     """
+    if max_distance < 2:
+        return set()
+
+    ori_set = set(tuple(set(x)) for x in original)
+    fused_set = iter_fused_groups(original, max_distance, min_compl)
+    if max_fused is not None:
+        fused_set = islice(fused_set, max_fused)
 
-    def missing_elements(L):
-        start, end = L[0], L[-1]
-        return sorted(set(range(start, end + 1)).difference(L))
+    return ori_set.union(fused_set)
 
+
+def iter_fused_groups(original, max_distance=2, min_compl=0.20):
+    """
+    Lazily generate joined groups of phenotypes, see assemble_groups, fusing the leftmost groups first
+    [[1,2],[5,6]] -> ((1, 2), (5, 6))
+    :param original: Original list of lists of integers
+    :param max_distance: Maximum number of combinations
+    :param min_compl: Minimum fraction of complete term
+    :return: generator of tuples of grouped tuple index sequences
+    """
     ori_set = set(tuple(set(x)) for x in original)
+    ori_keys = set(frozenset(x) for x in ori_set)
 
-    fused_set = set()
-    final_set = set()
-    fused_set_uniq = set()
+    for distance in range(2, max_distance):
+        for comb in combinations(sorted(ori_set), distance):
+            indices = list(chain(*comb))
+            unique_indices = set(indices)
 
-    for distance in range(1, max_distance):
-        combs = list(combinations(ori_set, distance))
-        for comb in combs:
-            fused_comb = tuple(set(np.concatenate(comb)))
-            if fused_comb in ori_set:
+            # skip groups which overlap or fuse into one of the original groups
+            if len(unique_indices) != len(indices) or unique_indices in ori_keys:
                 continue
-            else:
-                fused_set.add(tuple(set(comb)))
-
-        for item in fused_set:
-            if len(set(np.concatenate(item))) == len(np.concatenate(item)):
-                sorted_seq = sorted(list(chain(*item)))
-                gaps = missing_elements(sorted_seq)
-                completeness = len(sorted_seq) / (len(sorted_seq) + len(gaps))
-                if completeness >= min_compl:
-                    fused_set_uniq.add(item)
-        final_set = set(ori_set.union(fused_set_uniq))
 
-    return final_set
+            completeness = len(indices) / (max(indices) - min(indices) + 1)
+            if completeness >= min_compl:
+                yield tuple(set(comb))
 
 
 def recombine_groups(group_indx, min_r_length=1, max_r_length=3):
@@ -436,20 +734,40 @@ def recombine_groups(group_indx, min_r_length=1, max_r_length=3):
     :param max_r_length: maximum length of combinations
     :return: list of lists of indices
     """
-    return_list = []
+    return list(iter_recombined_groups(group_indx, min_r_length, max_r_length))
+
+
+def iter_recombined_groups(group_indx, min_r_length=1, max_r_length=3):
+    """
+    Lazily generate unique combinations for each group of indices, see recombine_groups
+    :param group_indx: set of tuples, output of assemble_groups
+    :param min_r_length: minimum length of combinations
+    :param max_r_length: maximum length of combinations
+    :return: generator of lists of indices
+    """
+    seen = set()
     for group in group_indx:
+        new_comb = group_indices(group)
+        if tuple(new_comb) not in seen:
+            seen.add(tuple(new_comb))
+            yield new_comb
         for r_length in range(min_r_length, max_r_length):
-            try:
-                new_comb = sorted(list(np.concatenate(group)))
-            except:
-                new_comb = list(group)
-            if new_comb not in return_list:
-                return_list.append(new_comb)
-            for new_mix_comb in list(combinations(new_comb, r_length)):
-                new_mix_comb = sorted(new_mix_comb)
-                if new_mix_comb not in return_list:
-                    return_list.append(list(new_mix_comb))
-    return return_list
+            for new_mix_comb in combinations(new_comb, r_length):
+                if new_mix_comb not in seen:
+                    seen.add(new_mix_comb)
+                    yield list(new_mix_comb)
+
+
+def group_indices(group):
+    """
+    Sorted token indices of a group of indices, or of a fused group of them
+    ((5,), (1, 2)) -> [1, 2, 5]
+    :param group: tuple of indices, or tuple of tuples of indices
+    :return: sorted list of indices
+    """
+    if group and isinstance(group[0], tuple):
+        return sorted(chain(*group))
+    return sorted(group)
 
 
 def permute_leave_one_out(original_list, min_terms=1):
@@ -480,11 +798,12 @@ def self_evaluation(correct_spelling=False, resolve_conflicts=False):
     print("")
     logger.info('Running self evaluation, this may take a few minutes \n')
     i = 0
-    n_nodes = len(hpo_network.nodes)
+    ontology = resources.get('ontology')
+    n_nodes = len(ontology)
     ext = Extractor(correct_spelling=correct_spelling, remove_overlapping=True, resolve_conflicts=True)
-    for node in hpo_network:
+    for node in ontology:
         total += 1
-        term = hpo_network.nodes[node]['name']
+        term = ontology.name(node)
         hpids = []
         extracted = ext.hpo(term).hpids
         if str(node) in extracted:
@@ -494,7 +813,7 @@ def self_evaluation(correct_spelling=False, resolve_conflicts=False):
                 actual=node,
                 actual_name=term,
                 extracted=hpids,
-                extracted_name=[hpo_network.nodes[x]['name'] for x in hpids],
+                extracted_name=[ontology.name(x) for x in hpids],
             ))
 
         i += 1
@@ -0,0 +1,97 @@
+class PhraseMatcher(object):
+    """
+    Match stemmed phenotype phrases in a single left to right pass over a chunk
+
+    A window of stems is grown from every phenotype token until it hits a stem which is not a root of the search
+    tree, or becomes longer than the longest phrase of one of its stems, so the work per chunk is linear in the number
+    of tokens times the length of the longest phrase. Every phrase is stored under each of its stems, so a window is
+    looked up under its first stem. The search tree is only read, phrases are looked up as they are needed.
+    """
+
+    def __init__(self, search_tree):
+        self.search_tree = search_tree
+
+    def match(self, stemmed_tokens, is_content, max_neighbors=3, min_compl=0.20):
+        """
+        Find all phrases of the search tree in a sequence of stemmed tokens
+        Phenotype tokens are grouped into runs of adjacent tokens, as in group_sequence. A phrase may span up to
+        max_neighbors - 1 of these groups, provided they cover at least min_compl of the tokens between its ends.
+        :param stemmed_tokens: list of stemmed tokens
+        :param is_content: list of booleans, False for stop words and punctuation which are skipped
+        :param max_neighbors: max number of phenotype groups a phrase can span is max_neighbors - 1
+        :param min_compl: minimum fraction of phenotype tokens in a phrase spanning multiple groups
+        :return: list of tuples (token indices of first and last token of phrase, list of hpids)
+        """
+        max_groups = max_neighbors - 1
+        if max_groups < 1:
+            return []
+
+        # assign phenotype tokens to groups of adjacent tokens, with the length of the longest phrase of their stem
+        group_of = {}
+        group_bounds = []
+        max_length = {}
+        for i, stem in enumerate(stemmed_tokens):
+            lengths = self.search_tree.get(stem)
+            if not lengths:
+                continue
+            max_length[i] = max(lengths)
+            if group_bounds and group_bounds[-1][1] == i - 1:
+                group_bounds[-1][1] = i
+            else:
+                group_bounds.append([i, i])
+            group_of[i] = len(group_bounds) - 1
+
+        content = [i for i in range(len(stemmed_tokens)) if is_content[i]]
+
+        matches = []
+        for n, first in enumerate(content):
+            if first not in group_of:
+                continue
+            root = self.search_tree[stemmed_tokens[first]]
+            limit = max_length[first]
+            window = []
+            first_matches = []
+            for last in content[n:]:
+                stem = stemmed_tokens[last]
+                if last not in group_of:
+                    break
+                limit = min(limit, max_length[last])
+                window.append(stem)
+                if len(window) > limit:
+                    break
+
+                n_groups = group_of[last] - group_of[first] + 1
+                if n_groups > 1:
+                    if max_groups < 2:
+                        break
+                    if self._completeness(group_bounds, group_of[first], group_of[last], max_groups) < min_compl:
+                        continue
+
+                phrases = root.get(len(window))
+                hpids = phrases.get(' '.join(sorted(window))) if phrases else None
+                if hpids:
+                    first_matches.append(([first, last] if last != first else [first], hpids))
+
+            # longest phrases first
+            matches += first_matches[::-1]
+
+        return matches
+
+    @staticmethod
+    def _completeness(group_bounds, first_group, last_group, max_groups):
+        """best fraction of phenotype tokens between two groups, using at most max_groups groups"""
+        sizes = [end - start + 1 for start, end in group_bounds[first_group + 1:last_group]]
+        sizes = sorted(sizes, reverse=True)[:max_groups - 2]
+        n_tokens = sum(sizes)
+        for start, end in (group_bounds[first_group], group_bounds[last_group]):
+            n_tokens += end - start + 1
+        return n_tokens / (group_bounds[last_group][1] - group_bounds[first_group][0] + 1)
+
+
+def compile_matcher(search_tree):
+    """
+    Wrap search tree in a PhraseMatcher, the matcher holds no tables of its own so it is cheap to create per Extractor
+    :param search_tree: nested dictionary built by build_search_tree, CompactTree or OverlayTree
+    :return: PhraseMatcher
+    """
+    return PhraseMatcher(search_tree)
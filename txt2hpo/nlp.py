@@ -1,9 +1,13 @@
+import hashlib
+import weakref
+import numpy as np
 import spacy
 from negspacy.negation import Negex
-from gensim.parsing.preprocessing import remove_stopwords
-from txt2hpo.config import logger
-from txt2hpo.util import hpo_network, download_model
-from nltk.stem import RegexpStemmer
+from txt2hpo import __version__
+from txt2hpo.cache import artifact_key, artifact_path, collect_garbage, file_fingerprint, save_atomic
+from txt2hpo.config import logger, config
+from txt2hpo.util import download_model
+from txt2hpo import resources
 from spacy.tokens import Token
 
 
@@ -33,35 +37,200 @@ def nlp_model(negation_language="en"):
     return nlp
 
 
-try:
-    import en_core_sci_sm
-    nlp_sans_ner = en_core_sci_sm.load(disable=["tagger", "parser", "ner", "lemmatizer"])
-    logger.info('Using scispaCy language model\n')
-
-except ModuleNotFoundError:
-    rl = download_model(
-        "https://s3-us-west-2.amazonaws.com/ai2-s2-scispacy/releases/v0.2.4/en_core_sci_sm-0.2.4.tar.gz")
-    if rl == 0:
+def load_nlp_sans_ner():
+    """
+    Load language model used to tokenize text, without named entity recognition
+    :return: spaCy language model
+    """
+    try:
         import en_core_sci_sm
-        nlp_sans_ner = en_core_sci_sm.load(disable=["tagger", "parser", "ner"])
+        nlp_sans_ner = en_core_sci_sm.load(disable=["tagger", "parser", "ner", "lemmatizer"])
         logger.info('Using scispaCy language model\n')
-    else:
-        logger.info('scispaCy language model could not be loaded\n')
-        logger.info('Performing a one-time download of an English language model\n')
-        from spacy.cli import download
-        download('en_core_web_sm')
-        nlp_sans_ner = spacy.load("en_core_web_sm", disable=["tagger", "parser", "ner", "lemmatizer"])
+
+    except ModuleNotFoundError:
+        rl = download_model(
+            "https://s3-us-west-2.amazonaws.com/ai2-s2-scispacy/releases/v0.2.4/en_core_sci_sm-0.2.4.tar.gz")
+        if rl == 0:
+            import en_core_sci_sm
+            nlp_sans_ner = en_core_sci_sm.load(disable=["tagger", "parser", "ner"])
+            logger.info('Using scispaCy language model\n')
+        else:
+            logger.info('scispaCy language model could not be loaded\n')
+            logger.info('Performing a one-time download of an English language model\n')
+            from spacy.cli import download
+            download('en_core_web_sm')
+            nlp_sans_ner = spacy.load("en_core_web_sm", disable=["tagger", "parser", "ner", "lemmatizer"])
+
+    for not_a_stop in remove_from_stops.split(" "):
+        nlp_sans_ner.vocab[not_a_stop].is_stop = False
+        nlp_sans_ner.vocab[not_a_stop.capitalize()].is_stop = False
+
+    return nlp_sans_ner
+
 
 # these are used in hpo as part of phenotype definition, should block from filtering
 remove_from_stops = "first second third fourth fifth under over front back behind ca above below without no not "
 remove_from_stops += "out up side right left more less during than take move full few all to i "
 
-for not_a_stop in remove_from_stops.split(" "):
-    nlp_sans_ner.vocab[not_a_stop].is_stop = False
-    nlp_sans_ner.vocab[not_a_stop.capitalize()].is_stop = False
+resources.register('nlp_sans_ner', load_nlp_sans_ner)
+
+
+def __getattr__(name):
+    # language model is loaded on first access of its module attribute
+    if name == 'nlp_sans_ner':
+        return resources.get(name)
+    if name == 'st':
+        return resources.get('stemmer')
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# suffixes removed from words of at least stem_min_length characters
+stem_pattern = 'ing$|e$|able$|ic$|ia$|ity$|al$|ly$'
+stem_min_length = 7
+
+
+def load_stemmer():
+    """
+    Create the stemmer of phenotype tokens
+    :return: nltk RegexpStemmer
+    """
+    from nltk.stem import RegexpStemmer
+    return RegexpStemmer(stem_pattern, min=stem_min_length)
+
+
+resources.register('stemmer', load_stemmer)
+
+
+class StemCache(object):
+    """
+    Memoize stems of tokens, keyed by the ids of their lexeme and lemma in the spaCy string store
+    Stems are computed as st.stem(st.stem(lemma)) on first sight of a lexeme, the oldest stems are evicted once the
+    cache holds maxsize stems.
+    """
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.stems = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __call__(self, token):
+        key = (token.orth, token.lemma)
+        try:
+            stem = self.stems[key]
+            self.hits += 1
+            return stem
+        except KeyError:
+            pass
+
+        self.misses += 1
+        st = resources.get('stemmer')
+        stem = st.stem(st.stem(token.lemma_.lower()))
+        if len(self.stems) >= self.maxsize:
+            del self.stems[next(iter(self.stems))]
+            self.evictions += 1
+        self.stems[key] = stem
+        return stem
+
+    def stats(self):
+        """
+        Report cache usage
+        :return: dictionary of hits, misses, evictions, size and hit rate
+        """
+        lookups = self.hits + self.misses
+        return dict(hits=self.hits,
+                    misses=self.misses,
+                    evictions=self.evictions,
+                    size=len(self.stems),
+                    hit_rate=self.hits / lookups if lookups else 0.0,
+                    )
+
+    def clear(self):
+        self.stems = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+# stems shared by the search tree builder and the extractor
+stem_token = StemCache()
+
+
+class NegationCache(object):
+    """
+    Memoize negated tokens found by a negation model in a context
+    Contexts are looked up as strings, so the same context found for several terms or in several documents is
+    evaluated once. Contexts not seen before are run through the negation model together with nlp.pipe, the oldest
+    results of a model are evicted once the cache holds maxsize of its contexts. Results are held weakly by model, so
+    they are dropped along with the model.
+    """
 
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        # negation model -> dictionary of context, result
+        self.negated = weakref.WeakKeyDictionary()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
-st = RegexpStemmer('ing$|e$|able$|ic$|ia$|ity$|al$|ly$', min=7)
+    def __call__(self, negation_model, contexts):
+        """
+        Find negated tokens in contexts
+        :param negation_model: spaCy language model with negex pipe
+        :param contexts: list of context strings
+        :return: list of tuples (string of negated tokens, list of negated words), one per context
+        """
+        negated = self.negated.setdefault(negation_model, {})
+
+        found = {}
+        for context in contexts:
+            if context in found:
+                continue
+            try:
+                found[context] = negated[context]
+            except KeyError:
+                pass
+
+        new_contexts = list(dict.fromkeys(x for x in contexts if x not in found))
+        self.misses += len(new_contexts)
+        self.hits += len(contexts) - len(new_contexts)
+
+        if new_contexts:
+            negated_tokens = [' '.join([e.text for e in doc.ents if e._.negex])
+                              for doc in negation_model.pipe(new_contexts)]
+            negated_words = [tuple(t.text for t in doc) for doc in resources.get('nlp_sans_ner').pipe(negated_tokens)]
+            for context, result in zip(new_contexts, zip(negated_tokens, negated_words)):
+                found[context] = result
+                if len(negated) >= self.maxsize:
+                    del negated[next(iter(negated))]
+                    self.evictions += 1
+                negated[context] = result
+
+        return [(found[x][0], list(found[x][1])) for x in contexts]
+
+    def stats(self):
+        """
+        Report cache usage
+        :return: dictionary of hits, misses, evictions, size and hit rate
+        """
+        lookups = self.hits + self.misses
+        return dict(hits=self.hits,
+                    misses=self.misses,
+                    evictions=self.evictions,
+                    size=sum(len(x) for x in self.negated.values()),
+                    hit_rate=self.hits / lookups if lookups else 0.0,
+                    )
+
+    def clear(self):
+        self.negated = weakref.WeakKeyDictionary()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+# negations shared by all documents
+negation_cache = NegationCache()
 
 
 def similarity_term_to_context(term, context, model):
@@ -72,11 +241,12 @@ def similarity_term_to_context(term, context, model):
     :param model: doc2vec model used to score term given context
     :return: float
     """
+    from gensim.parsing.preprocessing import remove_stopwords
+
     def remove_out_of_vocab(tokens):
         return [x for x in tokens if x in model.vocab]
 
-    hpo_term = hpo_network.nodes[term]
-    hpo_term_definition = hpo_term['name']
+    hpo_term_definition = resources.get('ontology').name(term)
     term_tokens = remove_out_of_vocab(remove_stopwords(hpo_term_definition).split())
     context_tokens = remove_out_of_vocab(remove_stopwords(context).split())
     if term_tokens and context_tokens:
@@ -84,3 +254,131 @@ def similarity_term_to_context(term, context, model):
     else:
         sim = -0.999
     return sim
+
+
+class TermVectors(object):
+    """
+    Unit mean vectors of the in-vocabulary words of hpo term names, one row per hpo id
+    Cosine similarity of a term and a context is the dot product of their rows, equal to model.n_similarity of their
+    words as scored by similarity_term_to_context, so all terms of all contexts can be scored with one matrix product.
+    """
+
+    def __init__(self, ids, matrix, has_vector):
+        self.ids = ids
+        self.matrix = matrix
+        self.has_vector = has_vector
+        self.index = {hpid: i for i, hpid in enumerate(ids)}
+
+    def context_vector(self, context, model):
+        """
+        Unit mean vector of the in-vocabulary words of context
+        :param context: context of term
+        :param model: doc2vec model
+        :return: numpy array, None if no word of context is in vocabulary
+        """
+        from gensim import matutils
+        from gensim.parsing.preprocessing import remove_stopwords
+        tokens = [x for x in remove_stopwords(context).split() if x in model.vocab]
+        if not tokens:
+            return None
+        return matutils.unitvec(np.array([model[x] for x in tokens]).mean(axis=0))
+
+    def similarity(self, terms_in_context, model):
+        """
+        Score similarity (term|context) of groups of terms
+        :param terms_in_context: list of tuples (list of hpo ids, context)
+        :param model: doc2vec model the vectors were built with
+        :return: list of numpy arrays of scores, one per tuple, -0.999 for terms or contexts without vectors
+        """
+        contexts = list(dict.fromkeys(context for _, context in terms_in_context))
+        context_rows = {context: i for i, context in enumerate(contexts)}
+        context_vectors = np.zeros((len(contexts), self.matrix.shape[1]), dtype=self.matrix.dtype)
+        context_has_vector = np.zeros(len(contexts), dtype=bool)
+        for i, context in enumerate(contexts):
+            vector = self.context_vector(context, model)
+            if vector is not None:
+                context_vectors[i] = vector
+                context_has_vector[i] = True
+
+        terms = list(dict.fromkeys(term for group, _ in terms_in_context for term in group))
+        term_rows = np.array([self.index[term] for term in terms], dtype=np.int64)
+        term_columns = {term: i for i, term in enumerate(terms)}
+
+        scores = context_vectors @ self.matrix[term_rows].T
+        scores[~context_has_vector] = -0.999
+        scores[:, ~self.has_vector[term_rows]] = -0.999
+
+        return [scores[context_rows[context], [term_columns[term] for term in group]]
+                for group, context in terms_in_context]
+
+
+# term vectors of each model, held weakly by model so they are dropped along with it
+_term_vectors = weakref.WeakKeyDictionary()
+
+
+def build_term_vectors(model):
+    """
+    Compute unit mean vectors of hpo term names
+    :param model: doc2vec model
+    :return: tuple of list of hpo ids, matrix of vectors, array True where a term has words in vocabulary
+    """
+    from gensim import matutils
+    from gensim.parsing.preprocessing import remove_stopwords
+    logger.info('Building hpo term vectors, this is a one time thing \n')
+    ontology = resources.get('ontology')
+    ids = list(ontology.ids)
+    matrix = np.zeros((len(ids), model.vector_size), dtype=np.float32)
+    has_vector = np.zeros(len(ids), dtype=bool)
+    for i, name in enumerate(ontology.names):
+        tokens = [x for x in remove_stopwords(name).split() if x in model.vocab]
+        if tokens:
+            matrix[i] = matutils.unitvec(np.array([model[x] for x in tokens]).mean(axis=0))
+            has_vector[i] = True
+    return ids, matrix, has_vector
+
+
+def load_term_vectors(model):
+    """
+    Load hpo term vectors of a model from disk, build and save them if missing
+    Vectors are saved under a key of the ontology and model they are built from, vectors of others are removed.
+    :param model: doc2vec model
+    :return: TermVectors
+    """
+    if model in _term_vectors:
+        return _term_vectors[model]
+
+    import gensim
+    key = artifact_key(dict(obo=file_fingerprint(config.get('hpo', 'obo')),
+                            model=model_fingerprint(model),
+                            gensim_version=gensim.__version__,
+                            txt2hpo_version=__version__))
+    vectors_path = artifact_path('term_vectors', key, 'npz')
+    term_vectors = None
+    try:
+        with np.load(vectors_path) as fh:
+            term_vectors = TermVectors(fh['ids'].tolist(), fh['matrix'], fh['has_vector'])
+    except (FileNotFoundError, OSError, KeyError, ValueError) as e:
+        logger.info(f'HPO term vectors not found\n {e}')
+
+    if term_vectors is None:
+        term_vectors = TermVectors(*build_term_vectors(model))
+        save_atomic(vectors_path, lambda fh: np.savez(fh, ids=np.array(term_vectors.ids), matrix=term_vectors.matrix,
+                                                      has_vector=term_vectors.has_vector))
+        collect_garbage('term_vectors', key)
+
+    _term_vectors[model] = term_vectors
+    return term_vectors
+
+
+def model_fingerprint(model, n_rows=1000):
+    """
+    Identify a doc2vec model by its vocabulary and a sample of its vectors, without hashing all vectors
+    :param model: doc2vec model
+    :param n_rows: number of vectors sampled
+    :return: hex string
+    """
+    sha1 = hashlib.sha1()
+    sha1.update('\n'.join(model.index2word).encode('utf-8', 'surrogatepass'))
+    step = max(1, len(model.vectors) // n_rows)
+    sha1.update(np.ascontiguousarray(model.vectors[::step]).tobytes())
+    return sha1.hexdigest()
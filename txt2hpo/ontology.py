@@ -0,0 +1,330 @@
+import json
+import re
+
+import numpy as np
+
+from txt2hpo import resources
+from txt2hpo.cache import artifact_key, artifact_path, collect_garbage, file_fingerprint, save_atomic
+from txt2hpo.config import config, logger
+
+# roots for non-phenotype nodes
+non_phenotypes = {
+    'mortality_aging': 'HP:0040006',
+    'mode_of_inheritance': 'HP:0000005',
+    'clinical_modifier': 'HP:0012823',
+    'frequency': 'HP:0040279',
+    'clinical_course': 'HP:0031797',
+}
+
+# version of the layout of saved snapshots
+SNAPSHOT_VERSION = 3
+
+
+class Ontology(object):
+    """
+    Names, synonyms and hierarchy of HPO terms, without the networkx graph they are parsed into
+    Terms are numbered in the order of hp.obo. Parents of term i are
+    parent_ids[parent_offsets[i]:parent_offsets[i + 1]], its children child_ids[child_offsets[i]:child_offsets[i + 1]].
+    The transitive closure of the hierarchy is precomputed, ancestor_ids[ancestor_offsets[i]:ancestor_offsets[i + 1]]
+    are the sorted indices of term i and all its ancestors, ancestor_distances the least number of is_a steps from term
+    i to each of them. Terms of non-phenotype branches are labeled with the position of the name of their root in
+    non_pheno_names, other terms with -1.
+    """
+
+    def __init__(self, ids, names, synonyms, parent_offsets, parent_ids, child_offsets, child_ids,
+                 ancestor_offsets, ancestor_ids, ancestor_distances, non_pheno_names, non_pheno_labels, version=None):
+        self.ids = ids
+        self.names = names
+        self.synonyms = synonyms
+        self.parent_offsets = parent_offsets
+        self.parent_ids = parent_ids
+        self.child_offsets = child_offsets
+        self.child_ids = child_ids
+        self.ancestor_offsets = ancestor_offsets
+        self.ancestor_ids = ancestor_ids
+        self.ancestor_distances = ancestor_distances
+        self.non_pheno_names = non_pheno_names
+        self.non_pheno_labels = non_pheno_labels
+        self.version = version
+
+        self.index = {hpid: i for i, hpid in enumerate(ids)}
+        self.non_phenos = {ids[i]: non_pheno_names[label] for i, label in enumerate(non_pheno_labels.tolist())
+                           if label >= 0}
+        # type of each term, and 'phenotype' at position -1 for ids missing from the ontology
+        self._type_names = np.array(non_pheno_names + ['phenotype'], dtype=object)
+        self._types = np.append(non_pheno_labels.astype(np.int32), -1)
+        # ancestors of terms tested so far by is_a
+        self._ancestor_sets = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __contains__(self, hpid):
+        return hpid in self.index
+
+    def name(self, hpid):
+        """name of a term"""
+        return self.names[self.index[hpid]]
+
+    def parents(self, hpid):
+        """list of hpo ids of parents of a term"""
+        i = self.index[hpid]
+        return [self.ids[x] for x in self.parent_ids[self.parent_offsets[i]:self.parent_offsets[i + 1]]]
+
+    def children(self, hpid):
+        """list of hpo ids of children of a term"""
+        i = self.index[hpid]
+        return [self.ids[x] for x in self.child_ids[self.child_offsets[i]:self.child_offsets[i + 1]]]
+
+    def descendant_indices(self, i):
+        """sorted array of indices of descendants of term i"""
+        mask = self.subtree_mask([i])
+        mask[i] = False
+        return np.flatnonzero(mask).astype(np.int32)
+
+    def ancestor_indices(self, i):
+        """sorted array of indices of ancestors of term i"""
+        ancestors = self.ancestor_ids[self.ancestor_offsets[i]:self.ancestor_offsets[i + 1]]
+        return ancestors[ancestors != i]
+
+    def is_a(self, hpid, ancestor):
+        """
+        Test whether a term is in the subtree of another
+        :param hpid: hpo id
+        :param ancestor: hpo id of root of subtree
+        :return: True if hpid is ancestor or one of its descendants
+        """
+        try:
+            ancestors = self._ancestor_sets[hpid]
+        except KeyError:
+            i = self.index[hpid]
+            ancestors = frozenset(self.ancestor_ids[self.ancestor_offsets[i]:self.ancestor_offsets[i + 1]].tolist())
+            self._ancestor_sets[hpid] = ancestors
+        return self.index.get(ancestor, -1) in ancestors
+
+    def subtree_mask(self, roots):
+        """
+        Mark terms in subtrees
+        :param roots: indices of roots of subtrees
+        :return: boolean array, True for roots and their descendants
+        """
+        labels = self.branch_labels(roots)
+        return labels >= 0
+
+    def branch_labels(self, roots):
+        """
+        Label terms with the subtree they belong to, e.g. to roll terms up to organ systems
+        :param roots: indices of roots of subtrees
+        :return: array of position in roots of the subtree of each term, the last one for terms in several subtrees,
+                 -1 for terms in none
+        """
+        return _branch_labels(self.ancestor_offsets, self.ancestor_ids, roots)
+
+    def term_types(self, hpids):
+        """
+        Label HPO IDs with the non-phenotype branch they belong to
+        :param hpids: list of hpo ids
+        :return: list of names of non-phenotype roots, 'phenotype' for other terms
+        """
+        indices = np.fromiter((self.index.get(x, len(self.ids)) for x in hpids), dtype=np.int64, count=len(hpids))
+        return self._type_names[self._types[indices]].tolist()
+
+    def propagate(self, indices, counts=None, levels=None, roots=None):
+        """
+        Add counts of terms to their ancestors
+        :param indices: array of indices of terms
+        :param counts: array of counts of each term, 1 for each if None
+        :param levels: max number of is_a steps counts are propagated up, None to propagate up to the root
+        :param roots: indices of terms to report, all terms if None
+        :return: tuple of sorted array of indices of terms, array of their propagated counts
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        if counts is None:
+            counts = np.ones(len(indices), dtype=np.int64)
+
+        # positions of the closure rows of all terms, concatenated
+        starts = self.ancestor_offsets[indices].astype(np.int64)
+        lengths = self.ancestor_offsets[indices + 1] - starts
+        positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+        ancestors = self.ancestor_ids[positions]
+        counts = np.repeat(counts, lengths)
+        keep = np.ones(len(ancestors), dtype=bool)
+        if levels is not None:
+            keep &= self.ancestor_distances[positions] <= levels
+        if roots is not None:
+            is_root = np.zeros(len(self.ids), dtype=bool)
+            is_root[np.asarray(roots, dtype=np.int64)] = True
+            keep &= is_root[ancestors]
+
+        ids, inverse = np.unique(ancestors[keep], return_inverse=True)
+        return ids.astype(np.int32), np.bincount(inverse, weights=counts[keep], minlength=len(ids)).astype(np.int32)
+
+    def descendants(self, hpid):
+        """set of hpo ids of descendants of a term"""
+        return {self.ids[x] for x in self.descendant_indices(self.index[hpid])}
+
+    def ancestors(self, hpid):
+        """set of hpo ids of ancestors of a term"""
+        return {self.ids[x] for x in self.ancestor_indices(self.index[hpid])}
+
+
+def _ancestor_closure(parents):
+    """
+    Ancestors of every term, each term included as its own ancestor
+    :param parents: list of lists of indices of parents of each term
+    :return: list of dictionaries of index of ancestor, least number of is_a steps to it
+    """
+    closure = [None] * len(parents)
+    in_progress = set()
+    for i in range(len(parents)):
+        stack = [i]
+        while stack:
+            j = stack[-1]
+            if closure[j] is not None:
+                stack.pop()
+                continue
+            pending = [x for x in parents[j] if closure[x] is None]
+            if pending:
+                if in_progress.intersection(pending):
+                    raise ValueError('hp.obo has a cycle in its hierarchy')
+                in_progress.add(j)
+                stack.extend(pending)
+                continue
+            ancestors = {j: 0}
+            for parent in parents[j]:
+                for ancestor, distance in closure[parent].items():
+                    if ancestors.get(ancestor, distance + 2) > distance + 1:
+                        ancestors[ancestor] = distance + 1
+            closure[j] = ancestors
+            in_progress.discard(j)
+            stack.pop()
+    return closure
+
+
+def _branch_labels(ancestor_offsets, ancestor_ids, roots):
+    """position in roots of the last root among ancestors of each term, -1 if none"""
+    positions = np.full(len(ancestor_offsets) - 1, -1, dtype=np.int32)
+    positions[np.asarray(roots, dtype=np.int32)] = np.arange(len(roots), dtype=np.int32)
+    # every row of the closure holds the term itself, so no row is empty
+    return np.maximum.reduceat(positions[ancestor_ids], ancestor_offsets[:-1])
+
+
+def _csr(adjacency):
+    """offsets and targets arrays of a list of lists of indices"""
+    offsets = np.zeros(len(adjacency) + 1, dtype=np.int32)
+    offsets[1:] = np.cumsum([len(x) for x in adjacency])
+    targets = np.array([x for targets in adjacency for x in targets], dtype=np.int32)
+    return offsets, targets
+
+
+def clean_synonyms(synonyms):
+    """
+    Extract synonym strings from obo synonym lines
+    :param synonyms: list of obo synonym values, e.g. '"Hypotonia" EXACT []'
+    :return: list of quoted synonyms
+    """
+    return re.findall(r'"(.*?)"', ','.join(synonyms))
+
+
+def parse_ontology(obo_file=None):
+    """
+    Parse hp.obo into an Ontology
+    :param obo_file: path of obo file, defaults to configured hp.obo
+    :return: Ontology
+    """
+    import obonet
+    if obo_file is None:
+        obo_file = config.get('hpo', 'obo')
+    hpo_network = obonet.read_obo(obo_file)
+
+    ids = list(hpo_network.nodes)
+    index = {hpid: i for i, hpid in enumerate(ids)}
+    names = []
+    synonyms = []
+    parents = []
+    children = [[] for _ in ids]
+    for i, (hpid, data) in enumerate(hpo_network.nodes(data=True)):
+        names.append(data.get('name', ''))
+        synonyms.append(clean_synonyms(data['synonym']) if 'synonym' in data else [])
+        # edges point from a term to its parents
+        parents.append([index[x] for x in dict.fromkeys(hpo_network.successors(hpid))])
+        for parent in parents[-1]:
+            children[parent].append(i)
+
+    parent_offsets, parent_ids = _csr(parents)
+    child_offsets, child_ids = _csr(children)
+    closure = [sorted(x.items()) for x in _ancestor_closure(parents)]
+    ancestor_offsets, ancestor_ids = _csr([[i for i, _ in x] for x in closure])
+    ancestor_distances = np.array([d for x in closure for _, d in x], dtype=np.uint16)
+
+    # label non-phenotype branches, a term in several branches is labeled with the last of them
+    roots = [(label, index[hpid]) for label, hpid in enumerate(non_phenotypes.values()) if hpid in index]
+    branches = _branch_labels(ancestor_offsets, ancestor_ids, [i for _, i in roots])
+    non_pheno_labels = np.array([label for label, _ in roots] + [-1], dtype=np.int8)[branches]
+
+    return Ontology(ids, names, synonyms, parent_offsets, parent_ids, child_offsets, child_ids,
+                    ancestor_offsets, ancestor_ids, ancestor_distances, list(non_phenotypes), non_pheno_labels,
+                    version=hpo_network.graph.get('data-version'))
+
+
+def save_ontology(ontology, path):
+    """
+    Save an ontology snapshot, read with read_ontology
+    :param ontology: Ontology
+    :param path: path of npz file, replaced atomically
+    :return: None
+    """
+    terms = dict(ids=ontology.ids, names=ontology.names, synonyms=ontology.synonyms,
+                 non_pheno_names=ontology.non_pheno_names, version=ontology.version)
+    arrays = dict(terms=np.frombuffer(json.dumps(terms).encode('utf-8'), dtype=np.uint8),
+                  parent_offsets=ontology.parent_offsets,
+                  parent_ids=ontology.parent_ids,
+                  child_offsets=ontology.child_offsets,
+                  child_ids=ontology.child_ids,
+                  ancestor_offsets=ontology.ancestor_offsets,
+                  ancestor_ids=ontology.ancestor_ids,
+                  ancestor_distances=ontology.ancestor_distances,
+                  non_pheno_labels=ontology.non_pheno_labels)
+    save_atomic(path, lambda fh: np.savez(fh, **arrays))
+
+
+def read_ontology(path):
+    """
+    Read an ontology snapshot saved by save_ontology
+    :param path: path of npz file
+    :return: Ontology
+    """
+    with np.load(path) as fh:
+        terms = json.loads(fh['terms'].tobytes().decode('utf-8'))
+        return Ontology(terms['ids'], terms['names'], terms['synonyms'],
+                        fh['parent_offsets'], fh['parent_ids'], fh['child_offsets'], fh['child_ids'],
+                        fh['ancestor_offsets'], fh['ancestor_ids'], fh['ancestor_distances'],
+                        terms['non_pheno_names'], fh['non_pheno_labels'], version=terms['version'])
+
+
+def load_ontology():
+    """
+    Load ontology snapshot from disk, parse hp.obo and save it if missing
+    Snapshots are saved under a key of the content of hp.obo, snapshots of other versions are removed.
+    :return: Ontology
+    """
+    key = artifact_key(dict(obo=file_fingerprint(config.get('hpo', 'obo')),
+                            snapshot_version=SNAPSHOT_VERSION,
+                            non_phenotypes=non_phenotypes))
+    path = artifact_path('ontology', key, 'npz')
+    try:
+        return read_ontology(path)
+    except (FileNotFoundError, OSError, KeyError, ValueError) as e:
+        logger.info(f'Ontology snapshot not found\n {e}')
+
+    ontology = parse_ontology()
+    save_ontology(ontology, path)
+    collect_garbage('ontology', key)
+    return ontology
+
+
+resources.register('ontology', load_ontology)
@@ -0,0 +1,114 @@
+import gc
+import multiprocessing
+import os
+import time
+from collections import Counter
+from itertools import islice
+
+from txt2hpo.config import logger
+from txt2hpo.resources import preload
+from txt2hpo.extract import Extractor, Data
+from txt2hpo.util import remove_key
+
+# extractor shared copy-on-write with forked workers
+_extractor = None
+_batch_size = 50
+
+
+def extract_corpus(texts, n_workers=None, batch_size=50, shard_size=500, return_stats=False, **extractor_kwargs):
+    """
+    Extract hpo terms from many texts using a pool of forked worker processes
+    The extractor and its read-only resources (ontology, search tree, language and doc2vec models) are loaded once
+    in the parent process and shared copy-on-write with the workers.
+    :param texts: iterable of strings
+    :param n_workers: number of worker processes, defaults to number of cpus
+    :param batch_size: number of texts each worker tokenizes together
+    :param shard_size: number of texts sent to a worker at a time
+    :param return_stats: also return throughput and candidate_stats of the extractor of each worker
+    :param extractor_kwargs: arguments passed to Extractor
+    :return: list of Data objects in input order, (list, dict of worker stats) if return_stats
+    """
+    global _extractor, _batch_size
+
+    if n_workers is None:
+        n_workers = os.cpu_count()
+
+    # load all resources before forking, workers share them
+    preload()
+    _extractor = Extractor(**extractor_kwargs)
+    # load vectors before forking, workers share the memory-mapped pages
+    _extractor.data_model
+    _batch_size = batch_size
+
+    shards = _shard(texts, shard_size)
+
+    results = []
+    stats = {}
+    start = time.time()
+    try:
+        if n_workers > 1:
+            # move everything loaded so far to a permanent generation, so refcount updates in the workers
+            # do not trigger collections that touch (and un-share) these pages
+            gc.collect()
+            gc.freeze()
+            with multiprocessing.get_context('fork').Pool(n_workers) as pool:
+                for shard_results, shard_stats in pool.imap(_extract_shard, shards):
+                    results += [_to_data(*result) for result in shard_results]
+                    _add_stats(stats, shard_stats)
+        else:
+            for shard_results, shard_stats in map(_extract_shard, shards):
+                results += [_to_data(*result) for result in shard_results]
+                _add_stats(stats, shard_stats)
+    finally:
+        gc.unfreeze()
+        _extractor = None
+
+    elapsed = time.time() - start
+    for pid, worker_stats in stats.items():
+        worker_stats['texts_per_second'] = worker_stats['n_texts'] / worker_stats['seconds'] \
+            if worker_stats['seconds'] else 0.0
+        logger.info(f"worker {pid}: {worker_stats['n_texts']} texts in {worker_stats['seconds']:.2f}s "
+                    f"({worker_stats['texts_per_second']:.1f} texts/s)")
+    logger.info(f'Extracted {len(results)} texts in {elapsed:.2f}s using {n_workers} workers')
+
+    if return_stats:
+        return results, stats
+    return results
+
+
+def _shard(texts, shard_size):
+    """yield consecutive lists of texts"""
+    texts = iter(texts)
+    while True:
+        shard = list(islice(texts, shard_size))
+        if not shard:
+            break
+        yield shard
+
+
+def _extract_shard(texts):
+    """extract a shard of texts with the shared extractor, drop spaCy objects so results can be pickled"""
+    start = time.time()
+    candidate_stats = _extractor.candidate_stats.copy()
+    results = []
+    for data in _extractor.hpo_batch(texts, batch_size=_batch_size):
+        entries = remove_key(data.entries, 'matched_tokens')
+        negated_entries = remove_key(data.negated_entries, 'matched_tokens')
+        results.append((entries, negated_entries))
+    return results, dict(pid=os.getpid(), n_texts=len(texts), seconds=time.time() - start,
+                         candidate_stats=_extractor.candidate_stats - candidate_stats)
+
+
+def _to_data(entries, negated_entries):
+    """rebuild Data object from worker results"""
+    data = Data(entries=entries, model=_extractor.data_model, negation_model=_extractor.negation_model)
+    data.negated_entries = negated_entries
+    return data
+
+
+def _add_stats(stats, shard_stats):
+    """accumulate shard stats per worker"""
+    worker_stats = stats.setdefault(shard_stats['pid'], dict(n_texts=0, seconds=0.0, candidate_stats=Counter()))
+    worker_stats['n_texts'] += shard_stats['n_texts']
+    worker_stats['seconds'] += shard_stats['seconds']
+    worker_stats['candidate_stats'] += shard_stats['candidate_stats']
@@ -0,0 +1,104 @@
+import importlib
+import time
+
+from txt2hpo.config import logger
+
+# modules registering the resources of txt2hpo
+resource_modules = ['txt2hpo.ontology', 'txt2hpo.util', 'txt2hpo.nlp', 'txt2hpo.spellcheck', 'txt2hpo.build_tree']
+
+_loaders = {}
+# resources left out when preloading all resources
+_lazy = set()
+_resources = {}
+_timings = {}
+# time spent loading nested resources, for each loader in progress
+_nested = [0.0]
+
+
+def register(name, loader, preload=True):
+    """
+    Register a resource, loaded by calling loader the first time it is needed
+    :param name: name of resource
+    :param loader: function without arguments returning the resource
+    :param preload: False to only load the resource when it is used or preloaded by name
+    :return: None
+    """
+    _loaders[name] = loader
+    if preload:
+        _lazy.discard(name)
+    else:
+        _lazy.add(name)
+
+
+def get(name):
+    """
+    Get a resource, loading it on first use
+    :param name: name of resource
+    :return: resource
+    """
+    try:
+        return _resources[name]
+    except KeyError:
+        pass
+
+    if name not in _loaders:
+        _import_resource_modules()
+
+    # loaders may get other resources, only time spent in this loader is reported for it
+    _nested.append(0.0)
+    start = time.time()
+    try:
+        resource = _loaders[name]()
+    finally:
+        elapsed = time.time() - start
+        nested = _nested.pop()
+        _nested[-1] += elapsed
+    _timings[name] = elapsed - nested
+    _resources[name] = resource
+    logger.info(f'Loaded {name} in {_timings[name]:.2f}s')
+    return resource
+
+
+def is_loaded(name):
+    """
+    :param name: name of resource
+    :return: True if resource has been loaded
+    """
+    return name in _resources
+
+
+def preload(*names):
+    """
+    Load resources ahead of their first use, e.g. when starting a server
+    :param names: names of resources to load, all registered resources if none, except those registered with
+                  preload=False
+    :return: dictionary of seconds spent loading each resource
+    """
+    _import_resource_modules()
+    for name in names or [x for x in _loaders if x not in _lazy]:
+        get(name)
+    return timings()
+
+
+def timings():
+    """
+    Report time spent loading resources
+    :return: dictionary of resource name and seconds spent loading it, in load order
+    """
+    return dict(_timings)
+
+
+def clear(*names):
+    """
+    Drop loaded resources, they are loaded again on next use
+    :param names: names of resources to drop, all resources if none
+    :return: None
+    """
+    for name in names or list(_resources):
+        _resources.pop(name, None)
+        _timings.pop(name, None)
+
+
+def _import_resource_modules():
+    for module in resource_modules:
+        importlib.import_module(module)
@@ -1,13 +1,24 @@
 
 # Peter Norvig spell checker https://norvig.com/spell-correct.html
+import time
+import zlib
+from collections import OrderedDict
+import numpy as np
+from txt2hpo import __version__
+from txt2hpo.cache import artifact_key, artifact_path, collect_garbage, file_fingerprint, save_atomic
+from txt2hpo.config import logger, config
 from txt2hpo.data import load_spellcheck_vocab
-from txt2hpo.nlp import nlp_sans_ner
+from txt2hpo import resources
+from spacy.tokens import Doc
 
-spellcheck_vocab = load_spellcheck_vocab()
+letters = 'abcdefghijklmnopqrstuvwxyz'
 
 
-def P(word, N=sum(spellcheck_vocab.values())):
+def P(word, N=None):
     "Probability of `word`."
+    spellcheck_vocab = resources.get('spellcheck_vocab')
+    if N is None:
+        N = resources.get('spellcheck_total')
     if word in spellcheck_vocab:
         return spellcheck_vocab[word] / N
     else:
@@ -21,17 +32,17 @@ def correction(word):
 
 def candidates(word):
     "Generate possible spelling corrections for word."
-    return (known([word]) or known(edits1(word)) or known(edits2(word)) or [word])
+    return (known([word]) or known(edits1(word)) or known_edits2(word) or [word])
 
 
 def known(words):
     "The subset of `words` that appear in the dictionary of spellcheck_data."
+    spellcheck_vocab = resources.get('spellcheck_vocab')
     return set(w for w in words if w in spellcheck_vocab)
 
 
 def edits1(word):
     "All edits that are one edit away from `word`."
-    letters    = 'abcdefghijklmnopqrstuvwxyz'
     splits     = [(word[:i], word[i:])    for i in range(len(word) + 1)]
     deletes    = [L + R[1:]               for L, R in splits if R]
     transposes = [L + R[1] + R[0] + R[2:] for L, R in splits if len(R)>1]
@@ -45,28 +56,213 @@ def edits2(word):
     return (e2 for e1 in edits1(word) for e2 in edits1(e1))
 
 
-def spellcheck(text):
-    "correct spelling in a sentence"
-    # clean up text from punctuation marks
+def known_edits2(word):
+    "The subset of `edits2(word)` that appear in the dictionary, looked up in the deletion index."
+    hashes, word_ids = resources.get('spellcheck_index')
+    spellcheck_words = resources.get('spellcheck_words')
+
+    # any word two edits away shares a string with up to two deleted characters with `word`
+    probes = np.array([_crc(d) for d in deletes(word)], dtype=np.uint32)
+    starts = np.searchsorted(hashes, probes, side='left')
+    ends = np.searchsorted(hashes, probes, side='right')
+    candidates = set(spellcheck_words[i] for start, end in zip(starts, ends) for i in word_ids[start:end])
+
+    # keep candidates which are one edit away from an edit of `word`
+    word_edits = edits1(word)
+    alphabet = letters + ''.join(set(word) - set(letters))
+    return set(w for w in candidates if not word_edits.isdisjoint(edits1_inverse(w, alphabet)))
+
+
+def edits1_inverse(word, alphabet=letters):
+    "All strings built from `alphabet` and `word` that have `word` among their edits1."
+    splits     = [(word[:i], word[i:])    for i in range(len(word) + 1)]
+    deletes    = [L + c + R               for L, R in splits for c in alphabet]
+    transposes = [L + R[1] + R[0] + R[2:] for L, R in splits if len(R)>1]
+    replaces   = [L + c + R[1:]           for L, R in splits if R and R[0] in letters for c in alphabet]
+    inserts    = [L + R[1:]               for L, R in splits if R and R[0] in letters]
+    return set(deletes + transposes + replaces + inserts)
+
+
+def deletes(word, max_deletes=2):
+    "All strings with up to `max_deletes` characters deleted from `word`."
+    variants = {word}
+    frontier = {word}
+    for _ in range(max_deletes):
+        frontier = {w[:i] + w[i + 1:] for w in frontier for i in range(len(w))}
+        variants |= frontier
+    return variants
+
+
+def build_deletion_index():
+    """
+    Index dictionary words by the hashes of their variants with up to two deleted characters
+    :return: tuple of sorted array of hashes, array of positions of words in spellcheck_words
+    """
+    logger.info('Building spellcheck deletion index, this is a one time thing \n')
+    spellcheck_words = resources.get('spellcheck_words')
+    hashes = []
+    word_ids = []
+    for i, word in enumerate(spellcheck_words):
+        for variant in deletes(word):
+            hashes.append(_crc(variant))
+            word_ids.append(i)
+    hashes = np.array(hashes, dtype=np.uint32)
+    word_ids = np.array(word_ids, dtype=np.uint32)
+    order = np.argsort(hashes, kind='stable')
+    return hashes[order], word_ids[order]
+
+
+def load_deletion_index():
+    """
+    Load deletion index from disk, build and save it if missing
+    The index is saved under a key of the dictionary it is built from, indexes of other dictionaries are removed.
+    :return: tuple of sorted array of hashes, array of positions of words in spellcheck_words
+    """
+    key = artifact_key(dict(spellcheck_vocab=file_fingerprint(config.get('data', 'spellcheck_vocab')),
+                            txt2hpo_version=__version__))
+    index_path = artifact_path('spellcheck_index', key, 'npz')
+    try:
+        with np.load(index_path) as fh:
+            return fh['hashes'], fh['word_ids']
+    except (FileNotFoundError, OSError, KeyError, ValueError) as e:
+        logger.info(f'Spellcheck deletion index not found\n {e}')
+
+    deletion_index = build_deletion_index()
+    save_atomic(index_path, lambda fh: np.savez(fh, hashes=deletion_index[0], word_ids=deletion_index[1]))
+    collect_garbage('spellcheck_index', key)
+
+    return deletion_index
+
+
+def _crc(text):
+    return zlib.crc32(text.encode('utf-8', 'surrogatepass'))
+
+
+resources.register('spellcheck_vocab', load_spellcheck_vocab)
+resources.register('spellcheck_words', lambda: list(resources.get('spellcheck_vocab')))
+resources.register('spellcheck_total', lambda: sum(resources.get('spellcheck_vocab').values()))
+resources.register('spellcheck_index', load_deletion_index)
+
+
+def __getattr__(name):
+    # resources are loaded on first access of their module attribute
+    if name in ('spellcheck_vocab', 'spellcheck_words'):
+        return resources.get(name)
+    if name == 'deletion_index':
+        return resources.get('spellcheck_index')
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+class CorrectionCache(object):
+    """
+    Process-wide, size-bounded memo of word -> correction
+    Dictionary words and words in `skip` are returned as they are without searching for corrections, other words are
+    corrected once and kept until they are the least recently used of maxsize words.
+    """
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.corrections = OrderedDict()
+        self.clear()
+
+    def __call__(self, word, skip=None):
+        if word in resources.get('spellcheck_vocab'):
+            self.known += 1
+            return word
+
+        if skip is not None and word in skip:
+            self.skipped += 1
+            return word
+
+        try:
+            corrected = self.corrections[word]
+            self.corrections.move_to_end(word)
+            self.hits += 1
+            return corrected
+        except KeyError:
+            pass
+
+        self.misses += 1
+        start = time.time()
+        corrected = correction(word)
+        self.seconds += time.time() - start
+
+        if len(self.corrections) >= self.maxsize:
+            self.corrections.popitem(last=False)
+            self.evictions += 1
+        self.corrections[word] = corrected
+        return corrected
+
+    def stats(self):
+        """
+        Report cache usage
+        :return: dictionary of known and skipped words, hits, misses, evictions, size and seconds spent correcting
+        """
+        return dict(known=self.known,
+                    skipped=self.skipped,
+                    hits=self.hits,
+                    misses=self.misses,
+                    evictions=self.evictions,
+                    size=len(self.corrections),
+                    seconds=self.seconds,
+                    )
+
+    def clear(self):
+        self.corrections.clear()
+        self.known = 0
+        self.skipped = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.seconds = 0.0
+
+
+correction_cache = CorrectionCache()
+
+
+def cache_stats():
+    "Usage statistics of the correction cache."
+    return correction_cache.stats()
+
+
+def spellcheck(text, skip=None):
+    "correct spelling in a sentence, leaving words in `skip` as they are"
+    tokens = resources.get('nlp_sans_ner')(text)
+    return "".join(corrected + token.whitespace_ for corrected, token in zip(correct_tokens(tokens, skip), tokens))
+
+
+def spellcheck_doc(doc, skip=None):
+    "correct spelling of a tokenized sentence, returns a doc with the corrected tokens aligned one to one with `doc`"
+    words = correct_tokens(doc, skip)
+    if all(word == token.text for word, token in zip(words, doc)):
+        return doc
+
+    corrected_doc = Doc(doc.vocab, words=words, spaces=[bool(token.whitespace_) for token in doc])
+    for name, proc in resources.get('nlp_sans_ner').pipeline:
+        corrected_doc = proc(corrected_doc)
+    return corrected_doc
+
+
+def correct_tokens(tokens, skip=None):
+    "corrected text of each token"
     corrected_text = []
-    for token in nlp_sans_ner(text):
+    for token in tokens:
 
         if token.is_stop:
-            corrected_text.append(token.text_with_ws)
+            corrected_text.append(token.text)
 
         elif token.is_punct:
-            corrected_text.append(token.text_with_ws)
+            corrected_text.append(token.text)
 
         elif len(token) < 5:
-            corrected_text.append(token.text_with_ws)
+            corrected_text.append(token.text)
         else:
-            corrected = correction(token.text.lower())
+            corrected = correction_cache(token.text.lower(), skip)
             if token.text[0].isupper() and token.text[-1].islower():
                 corrected_text.append(corrected.capitalize())
             elif token.text[0].isupper() and token.text[-1].isupper():
                 corrected_text.append(corrected.upper())
             else:
                 corrected_text.append(corrected)
-            corrected_text.append(token.whitespace_)
 
-    return "".join(corrected_text)
\ No newline at end of file
+    return corrected_text
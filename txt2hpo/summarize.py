@@ -1,10 +1,15 @@
 
+import hashlib
 import json
+import multiprocessing
+import os
+import pickle
+from collections import deque
+from itertools import islice
 import pandas as pd
 import numpy as np
-from txt2hpo.util import group_pairs, summarize_tuples, df_from_tuples
+from txt2hpo.cache import save_atomic
 from txt2hpo.config import logger
-from functools import reduce
 
 
 def half_product(num_rows, num_columns):
@@ -14,84 +19,264 @@ def half_product(num_rows, num_columns):
             yield (m, n)
 
 
-def phenotype_distance(extracted_hpos):
+def phenotype_distance(extracted_hpos, as_array=False):
     """
     Given the return from hpo, find the normalized distance between all terms in the document.
     This could serve as a proxy for cooccurrence.
-    :param extracted_hpos: json string output of txt2hpo
+    :param extracted_hpos: json string output of txt2hpo, or Data object
+    :param as_array: return a structured array with fields hpo1, hpo2 and distance rather than a list of tuples
     :return: list of tuples (hpo1, hpo2, distance)
     """
+    if isinstance(extracted_hpos, str):
+        entries = json.loads(extracted_hpos)
+    else:
+        # same order as the json output of Data
+        entries = sorted(extracted_hpos.entries, key=lambda i: i['index'][0])
 
-    # load the extracted phenotypes into a pandas DataFrame
-    hpo_ids = json.loads(extracted_hpos)
-    df = pd.DataFrame(hpo_ids)
-    # make two rows for text offsets where more than one HPO term was identified
-    df = df.explode('hpid').reset_index(drop=True)
-    # location is the starting index of an HPO term in the document.
-    df['location'] = df['index'].apply(min)
+    # one row for each HPO term of an entry, location is the starting index of the entry in the document.
+    hpids = [hpid for entry in entries for hpid in entry['hpid']]
+    locations = np.array([min(entry['index']) for entry in entries for _ in entry['hpid']], dtype=np.int64)
+    names, codes = np.unique(np.array(hpids, dtype=str), return_inverse=True)
 
-    # use max_idx as a normalization factor (a proxy for how long the document is)
-    # TODO:
-    # Maybe include the length of the text in the json object as a top-level key.
-    max_idx = df['location'].max()
+    # pairs of the combinations and the diagonal, in the order of half_product, the later term of each pair first
+    first, second = np.triu_indices(len(locations))
 
-    # loop through the combinations and the diagonal, collect distances b/w each pair
-    phenotype_pairs = []
-    for hpo_pair in half_product(len(df), len(df)):
-        x, y = sorted(hpo_pair, reverse=True)
-        distance = abs(df.iloc[x]['location'] - df.iloc[y]['location']) / max_idx
-        phenotype_pairs.append((df.iloc[x]['hpid'], df.iloc[y]['hpid'], distance))
+    # use the last location as a normalization factor (a proxy for how long the document is)
+    if len(locations):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            distance = np.abs(locations[second] - locations[first]) / locations.max()
+    else:
+        distance = np.zeros(0)
 
-    return phenotype_pairs
+    if as_array:
+        phenotype_pairs = np.empty(len(distance), dtype=[('hpo1', names.dtype), ('hpo2', names.dtype),
+                                                         ('distance', np.float64)])
+        phenotype_pairs['hpo1'] = names[codes[second]]
+        phenotype_pairs['hpo2'] = names[codes[first]]
+        phenotype_pairs['distance'] = distance
+        return phenotype_pairs
 
+    return list(zip(names[codes[second]].tolist(), names[codes[first]].tolist(), distance.tolist()))
 
-def distances(array_of_extracted_hpos, min_n_distances=2, summary_method='mean'):
+
+def propagate_corpus(results, levels=None, roots=None, unique=True):
+    """
+    Count extracted terms and their ancestors in each document of a corpus
+    Counts are returned as compressed sparse rows, one row per document and one column per term of the ontology,
+    e.g. scipy.sparse.csr_matrix((counts, indices, indptr), shape=(len(results), len(resources.get('ontology'))))
+    :param results: iterable of Data objects, e.g. from Extractor.hpo_batch or extract_corpus
+    :param levels: max number of is_a steps terms are propagated up, None to propagate up to the root
+    :param roots: list of hpo ids to report, e.g. organ systems, all terms if None
+    :param unique: count each extracted hpo id once per document, otherwise count every entry it is found in
+    :return: tuple of arrays indptr, indices of terms in the ontology, counts
+    """
+    indptr = [0]
+    indices = []
+    counts = []
+    for data in results:
+        doc_indices, doc_counts = data.propagate(levels=levels, roots=roots, unique=unique)
+        indices.append(doc_indices)
+        counts.append(doc_counts)
+        indptr.append(indptr[-1] + len(doc_indices))
+
+    indices = np.concatenate(indices) if indices else np.zeros(0, dtype=np.int32)
+    counts = np.concatenate(counts) if counts else np.zeros(0, dtype=np.int32)
+    return np.array(indptr, dtype=np.int64), indices, counts
+
+
+class PairAccumulator(object):
+    """
+    Running summary of distances between pairs of HPO terms, fed one document at a time
+    Pairs of terms are keyed by interned ids of the terms, and their distance in each document is summarized by its
+    minimum. For each pair only the number of documents it is found in, and the sum and minimum of its distances are
+    kept, so memory is bounded by the number of distinct pairs rather than the number of documents.
+    """
+
+    def __init__(self):
+        self.term_ids = {}
+        self.terms = []
+        # (id of first term, id of second term) -> [number of documents, sum of distances, min distance]
+        self.pairs = {}
+
+    def _intern(self, hpid):
+        if hpid not in self.term_ids:
+            self.term_ids[hpid] = len(self.terms)
+            self.terms.append(hpid)
+        return self.term_ids[hpid]
+
+    def add(self, extracted_hpos):
+        """
+        Add distances between terms of a document
+        :param extracted_hpos: json string output of txt2hpo, or Data object
+        :return: None
+        """
+        pairs = phenotype_distance(extracted_hpos, as_array=True)
+        if not len(pairs):
+            return
+
+        # order terms of each pair by hpo id
+        swap = pairs['hpo1'] > pairs['hpo2']
+        first = np.where(swap, pairs['hpo2'], pairs['hpo1'])
+        second = np.where(swap, pairs['hpo1'], pairs['hpo2'])
+
+        names, codes = np.unique(np.concatenate([first, second]), return_inverse=True)
+        ids = np.array([self._intern(x) for x in names.tolist()], dtype=np.int64)
+        keys = ids[codes[:len(pairs)]] * len(self.terms) + ids[codes[len(pairs):]]
+
+        # minimum distance of each pair in the document, in order of first occurrence
+        unique_keys, first_seen, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        min_distances = np.full(len(unique_keys), np.inf)
+        with np.errstate(invalid='ignore'):
+            np.minimum.at(min_distances, inverse, pairs['distance'])
+        order = np.argsort(first_seen)
+
+        for key, distance in zip(unique_keys[order].tolist(), min_distances[order].tolist()):
+            pair = divmod(key, len(self.terms))
+            if pair not in self.pairs:
+                self.pairs[pair] = [0, 0.0, np.inf]
+            # documents where all terms are found at the start have no distances, pairs keep their place in order
+            if np.isnan(distance):
+                continue
+            stats = self.pairs[pair]
+            stats[0] += 1
+            stats[1] += distance
+            stats[2] = min(stats[2], distance)
+
+    def update(self, array_of_extracted_hpos):
+        """
+        Add distances between terms of many documents
+        :param array_of_extracted_hpos: iterable of json string outputs of txt2hpo, or Data objects
+        :return: None
+        """
+        for extracted_hpos in array_of_extracted_hpos:
+            self.add(extracted_hpos)
+
+    def merge(self, other):
+        """
+        Add the distances summarized by another accumulator, e.g. of the next chunk of documents
+        Merging accumulators of consecutive chunks in order gives the pairs, counts and minimums of a single
+        accumulator fed all documents, in the same order.
+        :param other: PairAccumulator
+        :return: None
+        """
+        ids = [self._intern(x) for x in other.terms]
+        for (a, b), (n, total, min_distance) in other.pairs.items():
+            pair = (ids[a], ids[b])
+            if pair in self.pairs:
+                stats = self.pairs[pair]
+                stats[0] += n
+                stats[1] += total
+                stats[2] = min(stats[2], min_distance)
+            else:
+                self.pairs[pair] = [n, total, min_distance]
+
+    def summary(self, min_n_distances=2, summary_method='mean'):
+        """
+        Summarize distances of pairs found in more than min_n_distances documents
+        :param min_n_distances: minimum number of coocurances / distances to summarize to filter
+        :param summary_method: (mean,min) how to summarize coocurances / distances
+        :return: pandas dataframe with columns idx1, idx2, mean_score or min_score, n
+        """
+        rows = [(self.terms[a], self.terms[b], stats) for (a, b), stats in self.pairs.items()
+                if stats[0] > min_n_distances]
+        if summary_method == 'mean':
+            scores = [total / n for _, _, (n, total, _) in rows]
+        else:
+            scores = [min_distance for _, _, (_, _, min_distance) in rows]
+        return pd.DataFrame({'idx1': [a for a, _, _ in rows],
+                             'idx2': [b for _, b, _ in rows],
+                             f'{summary_method}_score': np.array(scores, dtype=np.float64),
+                             'n': np.array([stats[0] for _, _, stats in rows], dtype=np.int64)})
+
+
+def distances(array_of_extracted_hpos, min_n_distances=2, summary_method='mean', n_workers=1, chunk_size=10000,
+              checkpoint_dir=None):
     """
     Summarize array of phenotype distances generated from parsing distinct documents
-    :param array_of_extracted_hpos: array of phenotype distances
+    Documents are read a chunk at a time, so array_of_extracted_hpos may be a generator, e.g. Extractor.hpo_batch.
+    :param array_of_extracted_hpos: iterable of json string outputs of txt2hpo, or Data objects
     :param min_n_distances: minimum number of coocurances / distances to summarize to filter
     :param summary_method: (mean,min) how to summarize coocurances / distances
+    :param n_workers: number of worker processes summarizing chunks of documents
+    :param chunk_size: number of documents summarized together
+    :param checkpoint_dir: directory to save the summary of each chunk to, and load it from when run again
     :return: pandas dataframe
     """
-    dfs = []
     if summary_method not in ['mean', 'min']:
         logger.critical(f'Summary method undefined: {summary_method} ')
-        return dfs
-    # process distances of each document into df
-    for extracted_hpo in array_of_extracted_hpos:
-
-        # get term-term pairwise distances for each document
-        phenotype_pairs = phenotype_distance(extracted_hpo)
-
-        # find identical pairs and combine their values
-        grouped_pairs = group_pairs(phenotype_pairs)
+        return []
 
-        # get summary metric for each term pair
-        summarized_pairs = summarize_tuples(grouped_pairs)
+    accumulator = accumulate_distances(array_of_extracted_hpos, n_workers=n_workers, chunk_size=chunk_size,
+                                       checkpoint_dir=checkpoint_dir)
+    return accumulator.summary(min_n_distances=min_n_distances, summary_method=summary_method)
 
-        # make a dataframe and append it to list
-        tup_df = df_from_tuples(summarized_pairs)
 
-        dfs.append(tup_df)
-
-    # merge dataframes
-    dfs_merged = reduce(lambda x, y: pd.merge(x, y, on=['idx1', 'idx2'], how="outer"), dfs)
+def accumulate_distances(array_of_extracted_hpos, n_workers=1, chunk_size=10000, checkpoint_dir=None):
+    """
+    Summarize distances between terms of many documents, in parallel
+    Documents are split into chunks of chunk_size documents, each chunk is summarized by a worker, and the summaries
+    of chunks are merged in input order. Results only depend on chunk_size, not on the number of workers.
+    With a checkpoint_dir, the summary of each chunk is saved under a hash of its documents, and chunks which were
+    already summarized are loaded instead, so an interrupted run can be resumed.
+    :param array_of_extracted_hpos: iterable of json string outputs of txt2hpo, or Data objects
+    :param n_workers: number of worker processes
+    :param chunk_size: number of documents summarized together
+    :param checkpoint_dir: directory of summaries of chunks, None not to save them
+    :return: PairAccumulator
+    """
+    chunks = ((i, chunk, checkpoint_dir) for i, chunk in enumerate(_chunk_documents(array_of_extracted_hpos,
+                                                                                     chunk_size)))
+    accumulator = PairAccumulator()
+    if n_workers > 1:
+        with multiprocessing.get_context('fork').Pool(n_workers) as pool:
+            # keep a few chunks queued for each worker, never the whole input, and merge them in input order
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.apply_async(_accumulate_chunk, (chunk,)))
+                if len(pending) >= 2 * n_workers:
+                    accumulator.merge(pending.popleft().get())
+            while pending:
+                accumulator.merge(pending.popleft().get())
+    else:
+        for chunk_accumulator in map(_accumulate_chunk, chunks):
+            accumulator.merge(chunk_accumulator)
+    return accumulator
 
-    dfs_merged['values'] = dfs_merged.values.tolist()
-    # remove nan from list of distance values
-    dfs_merged['values'] = dfs_merged['values'].apply(lambda x: [v for v in x if ~np.isnan(v)])
 
-    # keep relationships with at least 3 distance values
-    dfs_merged['n'] = dfs_merged['values'].apply(len)
-    dfs_merged = dfs_merged[dfs_merged['n'] > min_n_distances]
+def _chunk_documents(array_of_extracted_hpos, chunk_size):
+    """yield lists of json strings of consecutive documents, Data objects are reduced to their hpids and offsets"""
+    documents = iter(array_of_extracted_hpos)
+    while True:
+        chunk = []
+        for extracted_hpos in islice(documents, chunk_size):
+            if not isinstance(extracted_hpos, str):
+                entries = sorted(extracted_hpos.entries, key=lambda i: i['index'][0])
+                extracted_hpos = json.dumps([dict(hpid=x['hpid'], index=x['index']) for x in entries])
+            chunk.append(extracted_hpos)
+        if not chunk:
+            break
+        yield chunk
 
-    # summarize
-    if summary_method == 'mean':
-        dfs_merged['mean_score'] = dfs_merged['values'].apply(np.mean)
-        dfs_merged = dfs_merged[['mean_score', 'n']]
 
-    elif summary_method == 'min':
-        dfs_merged['min_score'] = dfs_merged['values'].apply(np.min)
-        dfs_merged = dfs_merged[['min_score', 'n']]
+def _accumulate_chunk(args):
+    """summarize distances of a chunk of documents, or load the summary checkpointed by a previous run"""
+    index, documents, checkpoint_dir = args
+    path = None
+    if checkpoint_dir is not None:
+        digest = hashlib.sha1()
+        for document in documents:
+            digest.update(document.encode('utf-8'))
+            digest.update(b'\0')
+        path = os.path.join(checkpoint_dir, f'pairs-{index:08d}-{digest.hexdigest()[:16]}.pkl')
+        try:
+            with open(path, 'rb') as fh:
+                return pickle.load(fh)
+        except (FileNotFoundError, OSError, EOFError, pickle.UnpicklingError):
+            pass
 
-    return dfs_merged.reset_index()
+    accumulator = PairAccumulator()
+    accumulator.update(documents)
+    if path is not None:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        save_atomic(path, lambda fh: pickle.dump(accumulator, fh))
+    return accumulator
@@ -1,43 +1,121 @@
-import pandas as pd
-
 import math
-import obonet
-import re
 import sys
 import subprocess
 import os
-import networkx as nx
+import numpy as np
 from txt2hpo.config import config
-
-# hpo_network = obonet.read_obo(obo_file)
-
-obo_file = config.get('hpo', 'obo')
-
-hpo_network = obonet.read_obo(obo_file)
-for node_id, data in hpo_network.nodes(data=True):
-    # clean synonyms
-    synonyms = []
-    if 'synonym' in data:
-        for synonym in data['synonym']:
-            synonyms.append(synonym)
-        hpo_network.nodes[node_id]['synonyms'] = re.findall(r'"(.*?)"', ','.join(synonyms))
-
-# roots for non-phenotype nodes
-non_phenotypes = {
-    'mortality_aging': 'HP:0040006',
-    'mode_of_inheritance': 'HP:0000005',
-    'clinical_modifier': 'HP:0012823',
-    'frequency': 'HP:0040279',
-    'clinical_course': 'HP:0031797',
-}
-
-non_phenos = {}
-# remove non-phenotype branches
-for name, hpo_id in non_phenotypes.items():
-    if hpo_id in hpo_network.nodes:
-        children = nx.ancestors(hpo_network, hpo_id)
-        for hpid in [hpo_id] + list(children):
-            non_phenos[hpid] = name
+from txt2hpo.ontology import non_phenotypes, clean_synonyms
+from txt2hpo import resources
+
+
+def load_hpo_network():
+    """
+    Parse hp.obo into a networkx graph, with quoted synonyms cleaned into a 'synonyms' list
+    txt2hpo itself uses the ontology resource, see txt2hpo.ontology, the graph is only parsed when asked for.
+    :return: networkx MultiDiGraph
+    """
+    import obonet
+    hpo_network = obonet.read_obo(config.get('hpo', 'obo'))
+    for node_id, data in hpo_network.nodes(data=True):
+        # clean synonyms
+        if 'synonym' in data:
+            hpo_network.nodes[node_id]['synonyms'] = clean_synonyms(data['synonym'])
+    return hpo_network
+
+
+def load_non_phenos():
+    """
+    Label terms of non-phenotype branches with the name of their root
+    :return: dictionary of hpo id, name of non-phenotype root
+    """
+    return resources.get('ontology').non_phenos
+
+
+def obo_data_version(obo_file=None):
+    """
+    Read data-version of an obo file from its header, without parsing the ontology
+    :param obo_file: path of obo file, defaults to configured hp.obo
+    :return: data-version string, None if not found
+    """
+    if obo_file is None:
+        obo_file = config.get('hpo', 'obo')
+    with open(obo_file, 'rt') as fh:
+        for line in fh:
+            if line.startswith('['):
+                break
+            if line.startswith('data-version:'):
+                return line.split(':', 1)[1].strip()
+    return None
+
+
+resources.register('hpo_network', load_hpo_network, preload=False)
+resources.register('non_phenos', load_non_phenos)
+resources.register('hpo_node_order', lambda: resources.get('ontology').index)
+# indices of subtrees of the ontology, filled on first use by subtree_indices
+resources.register('hpo_subtrees', dict)
+
+
+def subtree_indices(hpid):
+    """
+    Find a term and its descendants
+    :param hpid: hpo id of root of subtree
+    :return: array of indices of terms in hpo_node_order, empty if hpid is not in the ontology
+    """
+    subtrees = resources.get('hpo_subtrees')
+    if hpid not in subtrees:
+        ontology = resources.get('ontology')
+        if hpid in ontology:
+            subtrees[hpid] = np.flatnonzero(ontology.subtree_mask([ontology.index[hpid]])).astype(np.int32)
+        else:
+            subtrees[hpid] = np.array([], dtype=np.int32)
+    return subtrees[hpid]
+
+
+def term_mask(masked_terms=None, masked_subtrees=None):
+    """
+    Mark HPO IDs to exclude from results
+    :param masked_terms: list of hpo ids to exclude
+    :param masked_subtrees: list of hpo ids to exclude along with their descendants
+    :return: boolean array indexed by hpo_node_order, True for excluded terms, None if nothing is excluded
+    """
+    if not masked_terms and not masked_subtrees:
+        return None
+    node_order = resources.get('hpo_node_order')
+    mask = np.zeros(len(node_order), dtype=bool)
+    mask[[node_order[x] for x in masked_terms or [] if x in node_order]] = True
+    for hpid in masked_subtrees or []:
+        mask[subtree_indices(hpid)] = True
+    return mask
+
+
+def combine_masks(*masks):
+    """union of term masks, None if no mask is given"""
+    masks = [x for x in masks if x is not None]
+    if not masks:
+        return None
+    return np.logical_or.reduce(masks)
+
+
+def unmasked_hpids(hpids, mask):
+    """
+    Drop masked HPO IDs
+    :param hpids: list of hpo ids
+    :param mask: boolean array from term_mask, or None
+    :return: list of hpo ids which are not masked
+    """
+    if mask is None:
+        return hpids
+    node_order = resources.get('hpo_node_order')
+    return [x for x in hpids if not mask[node_order[x]]]
+
+
+def __getattr__(name):
+    # resources are loaded on first access of their module attribute
+    if name in ('hpo_network', 'non_phenos'):
+        return resources.get(name)
+    if name == 'obo_file':
+        return config.get('hpo', 'obo')
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def group_pairs(phenotype_pairs):
@@ -69,6 +147,7 @@ def summarize_tuples(pairs, how='min'):
 
 def df_from_tuples(tuples):
     """make pandas df from tuples"""
+    import pandas as pd
     tup_df = pd.DataFrame(tuples, columns=['term_a','term_b','score'])
     tup_df.index = pd.MultiIndex.from_arrays(tup_df[['term_a', 'term_b']].values.T, names=['idx1', 'idx2'])
     tup_df = tup_df[['score']]